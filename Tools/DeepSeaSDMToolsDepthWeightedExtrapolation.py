@@ -3,10 +3,82 @@ import arcpy
 import os
 from arcpy import env
 from arcpy.sa import *
-from Includes import load_depth_string
+from Includes import DepthLevels
+from Includes import DepthMaskStack
+from Includes import GridDescriptor
+from Includes import array_to_raster
+from Includes import RasterBlockWriter
+from Includes import ReprojectionCache
+from Includes import composite_levels
+from Includes import interpolate_levels
+from Includes import read_raster_strip
+import numpy as np
 
 arcpy.CheckOutExtension("Spatial")
 
+# Each cell takes the layer of the deepest level it reaches (the cookie cutter), or is interpolated
+# linearly between the levels above and below its depth on the bathymetry
+METHODS = ["Nearest level", "Linear between levels"]
+
+
+class LevelIndexSource(object):
+    """The level index of the bathymetry extracted by the Extract Depths tool, read strip by strip.
+       A packed mask stack (bathmasks) or the bathindex raster is read directly, otherwise the
+       bathN masks covering each cell are counted, as the masks are nested."""
+
+    def __init__(self, input_bathymetry, depth_levels, no_data_value=349000000.0):
+        self.no_data_value = no_data_value
+        self.mask_stack = None
+        self.layers = None
+        self.count_masks = False
+
+        for mask_stack in [input_bathymetry, os.path.join(input_bathymetry, "bathmasks")]:
+            if DepthMaskStack.exists(mask_stack):
+                self.mask_stack = DepthMaskStack(mask_stack)
+                self.check_levels(self.mask_stack.levels, depth_levels, mask_stack)
+                self.grid = self.mask_stack.grid
+                self.spatial_reference = arcpy.SpatialReference()
+                self.spatial_reference.loadFromString(self.mask_stack.spatial_reference)
+                self.description = "packed depth masks in " + mask_stack
+                return
+
+        index_raster = os.path.join(input_bathymetry, "bathindex")
+        if arcpy.Exists(index_raster) and os.path.exists(index_raster + ".json"):
+            self.check_levels(DepthLevels.load(index_raster + ".json"), depth_levels, index_raster)
+            self.layers = [index_raster]
+            self.description = "level index " + index_raster
+        else:
+            self.layers = [os.path.join(input_bathymetry, "bath" + DepthLevels.label(depth)) for depth in depth_levels]
+            self.count_masks = True
+            self.description = "depth masks bath" + DepthLevels.label(depth_levels[0]) + " to bath" + \
+                               DepthLevels.label(depth_levels[-1]) + " in " + input_bathymetry
+        self.grid = GridDescriptor.from_raster(self.layers[0])
+        self.spatial_reference = arcpy.Describe(self.layers[0]).spatialReference
+
+    @staticmethod
+    def check_levels(levels, depth_levels, path):
+        if list(levels.depths) != list(depth_levels.depths):
+            raise Exception(str(path) + " was extracted for other depths than " + str(depth_levels.name))
+
+    def read(self, row, rows):
+        if self.mask_stack is not None:
+            return self.mask_stack.level_index((row, row + rows, 0, self.grid.cols))
+        if not self.count_masks:
+            return read_raster_strip(self.layers[0], self.grid, row, rows, -1).astype(np.int16)
+        covered = np.zeros((rows, self.grid.cols), dtype=np.int16)
+        for layer in self.layers:
+            covered += read_raster_strip(layer, self.grid, row, rows, 0) != 0
+        return covered - 1
+
+
+def read_levels(layers, grid, row, rows, no_data_value=349000000.0):
+    """float32 (level, row, col) stack of the environment layers over a strip, NaN for NoData."""
+    stack = np.empty((len(layers), rows, grid.cols), dtype=np.float32)
+    for level, layer in enumerate(layers):
+        stack[level] = read_raster_strip(layer, grid, row, rows, no_data_value)
+    stack[stack == np.float32(no_data_value)] = np.nan
+    return stack
+
 
 class DeepSeaSDMToolsDepthWeightedExtrapolation(object):
     """This class has the methods you need to define
@@ -81,6 +153,25 @@ class DeepSeaSDMToolsDepthWeightedExtrapolation(object):
                                            )
         output_raster.value = r"D:\Example\DeepSeaSDMToolsDepthWeightedExtrapolation\example.tif"
         params.append(output_raster)
+
+        method = arcpy.Parameter(name="method",
+                                 displayName="Vertical method",
+                                 datatype="GPString",
+                                 parameterType="Optional",
+                                 direction="Input",
+                                 )
+        method.filter.type = "ValueList"
+        method.filter.list = METHODS
+        method.value = METHODS[0]
+        params.append(method)
+
+        bathymetry = arcpy.Parameter(name="bathymetry",
+                                     displayName="Bathymetry raster the depths were extracted from (for linear interpolation)",
+                                     datatype="DERasterDataset",
+                                     parameterType="Optional",
+                                     direction="Input",
+                                     )
+        params.append(bathymetry)
         
         return params
 
@@ -106,11 +197,18 @@ class DeepSeaSDMToolsDepthWeightedExtrapolation(object):
         environment_append = parameters[3].valueAsText
         temporary_directory = parameters[4].valueAsText
         output_raster = parameters[5].valueAsText
+        method = parameters[6].valueAsText or METHODS[0]
+        bathymetry = parameters[7].valueAsText
 
         # Define the options the script will use later
-        # load depth strings from Includes.py
-        depths_list = load_depth_string(depths)
+        # load depth levels from Includes.py
+        depth_levels = DepthLevels.get(depths)
+        depths_list = [int(depth) for depth in depth_levels]
         arcpy.AddMessage(depths_list)
+        no_data_value = 349000000.0
+
+        if method == "Linear between levels" and not bathymetry:
+            raise Exception("Linear interpolation between levels needs the bathymetry raster.")
 
         if not os.path.exists(temporary_directory):
             os.makedirs(temporary_directory)
@@ -118,45 +216,92 @@ class DeepSeaSDMToolsDepthWeightedExtrapolation(object):
         arcpy.ResetEnvironments()
         arcpy.env.overwriteOutput = "true"
 
-        # Set environment variables
+        source = LevelIndexSource(input_bathymetry, depth_levels, no_data_value)
+        grid = source.grid
+        spf = source.spatial_reference
+        arcpy.AddMessage("Depth levels from " + source.description)
+
+        # Set environment variables, the environment layers are resampled onto the bathymetry grid
         env.mask = ""
         arcpy.AddMessage("Mask is: " + str(arcpy.env.mask))
-        description = arcpy.Describe(os.path.join(input_bathymetry, "bath" + str(int(float(depths_list[0])))))
-        cellsize1 = description.children[0].meanCellHeight
-        env.cellSize = cellsize1
+        env.cellSize = grid.cell_width
         arcpy.AddMessage("Cell size is: " + str(arcpy.env.cellSize))
-        arcpy.AddMessage(os.path.join(input_bathymetry, "bath" + str(int(float(depths_list[0])))))
-        extraster = Raster(os.path.join(input_bathymetry, "bath" + str(int(float(depths_list[0])))))
-        extent1 = extraster.extent
-        env.extent = extent1
+        env.extent = arcpy.Extent(*grid.extent)
         arcpy.AddMessage("Extent is: " + str(arcpy.env.extent))
+        if source.layers is not None:
+            env.snapRaster = source.layers[0]
+        else:
+            # A packed mask stack is no raster, so a single cell raster at the corner of its grid
+            # gives the snapping
+            snap_raster = os.path.join(temporary_directory, "snapgrid")
+            array_to_raster(np.zeros((1, 1), dtype=np.float32),
+                            GridDescriptor(grid.x_min, grid.y_min, grid.cell_width, grid.cell_height, 1, 1),
+                            snap_raster, spf)
+            env.snapRaster = snap_raster
         arcpy.env.workspace = temporary_directory
-        spf = arcpy.Describe(os.path.join(input_bathymetry, "bath" + str(int(float(depths_list[0]))))).spatialReference
         arcpy.AddMessage("Coord sys is: " + str(spf.name))
 
+        depth = None
         try:
-            # loop through the layers
+            # Bring every layer onto the bathymetry grid, layers already brought onto it by an
+            # earlier run with the same inputs come from the cache in the temporary directory
+            cache = ReprojectionCache(os.path.join(temporary_directory, "reprojected"))
+            layers = []
             for item in depths_list:
-                depth = int(float(item))
-                arcpy.AddMessage("Resizing layer " + str(depth) + " " + input_environment + "/" + environment_append + str(depth))
-                arcpy.ProjectRaster_management(os.path.join(input_environment, environment_append + str(depth)),
-                                               os.path.join(temporary_directory, environment_append + "a" + str(depth)), spf)
-                TempData = arcpy.sa.ApplyEnvironment(os.path.join(temporary_directory, environment_append + "a" + str(depth)))
-                arcpy.AddMessage("Extracting " + str(depth) + " to mask")
-                outExtractByMask = ExtractByMask(TempData, os.path.join(input_bathymetry, "bath" + str(depth)))
-                outExtractByMask.save(temporary_directory + "/clip" + str(depth))
-                arcpy.AddMessage("Adding " + str(depth) + " to final layer")
-                arcpy.Mosaic_management(temporary_directory + "/clip" + str(depth), temporary_directory + "/clip" + str(int(float(depths_list[0]))),
-                                        "LAST")
-                if depth == int(float(depths_list[-1])):
-                    arcpy.AddMessage("Creating the final layer for you, which will be called " + str(output_raster))
-                    arcpy.CopyRaster_management(temporary_directory + "/clip" + str(int(float(depths_list[0]))), output_raster)
-
-                arcpy.AddMessage("next layer " + str(depth))
+                depth = item
+                environment_layer = os.path.join(input_environment, environment_append + str(depth))
+
+                def reproject(output, environment_layer=environment_layer, depth=depth):
+                    arcpy.AddMessage("Resizing layer " + str(depth) + " " + input_environment + "/" + environment_append + str(depth))
+                    arcpy.ProjectRaster_management(environment_layer, os.path.join(temporary_directory, environment_append + "a" + str(depth)),
+                                                   spf, "NEAREST")
+                    TempData = arcpy.sa.ApplyEnvironment(os.path.join(temporary_directory, environment_append + "a" + str(depth)))
+                    TempData.save(output)
+
+                layers.append(cache.fetch(environment_layer, spf.exportToString(), grid.cell_width, "NEAREST", grid, reproject))
+                # Strips are read by position, so a layer off the grid would give values of other cells
+                if not GridDescriptor.from_raster(layers[-1]).aligned(grid):
+                    raise Exception(str(layers[-1]) + " is not on the grid of the depth levels, " + repr(grid) + ".")
+            cache.save()
+
+            if method == "Linear between levels" and not GridDescriptor.from_raster(bathymetry).aligned(grid):
+                arcpy.AddMessage("Resampling " + str(bathymetry) + " onto the depth levels grid")
+                arcpy.sa.ApplyEnvironment(bathymetry).save(os.path.join(temporary_directory, "bathgrid"))
+                bathymetry = os.path.join(temporary_directory, "bathgrid")
+
+            # Composite all levels strip by strip in one pass, each cell taking the layer at its
+            # depth, and write the output once
+            arcpy.AddMessage("Creating the final layer for you, which will be called " + str(output_raster))
+            depth = None
+            block_rows = max(1, (16777216 // len(layers)) // grid.cols)
+            with RasterBlockWriter(output_raster, grid, spf, no_data_value) as writer:
+                for row in range(0, grid.rows, block_rows):
+                    rows = min(block_rows, grid.rows - row)
+                    level_index = source.read(row, rows)
+                    level_stop = int(level_index.max()) + 1
+                    if level_stop > 0 and method == "Linear between levels":
+                        # Levels and weights either side of every cell depth, worked out once
+                        # for the strip
+                        cell_depth = -read_raster_strip(bathymetry, grid, row, rows, no_data_value).astype(np.float64)
+                        cell_depth[cell_depth == -no_data_value] = np.nan
+                        (lower, upper, weight) = depth_levels.weights(cell_depth)
+                        lower = np.where(level_index >= 0, lower, -1)
+                        level_stop = max(level_stop, int(upper.max()) + 1)
+                        stack = read_levels(layers[:level_stop], grid, row, rows, no_data_value)
+                        values = interpolate_levels(stack, lower, upper, weight)
+                        # Cells without data either side keep the cookie cutter value
+                        values = np.where(np.isnan(values), composite_levels(stack, level_index), values)
+                    elif level_stop > 0:
+                        values = composite_levels(read_levels(layers[:level_stop], grid, row, rows, no_data_value),
+                                                  level_index)
+                    else:
+                        values = np.full(level_index.shape, np.nan)
+                    writer.write(row, values.astype(np.float32))
 
         except:
             arcpy.AddMessage(arcpy.GetMessages())
             arcpy.AddMessage("Something has gone wrong likely with this: " + str(depth))
+            raise
 
         arcpy.AddMessage("Processing complete")
 
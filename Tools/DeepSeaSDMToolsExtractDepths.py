@@ -1,11 +1,17 @@
 #!/usr/bin/env python
 import arcpy
 import os
-from arcpy import env
-from arcpy.sa import *
-from Includes import load_depth_string
+import numpy as np
+from Includes import DepthLevels
+from Includes import DepthMaskStack
+from Includes import GridDescriptor
+from Includes import RasterBlockWriter
+from Includes import depth_level_index
+from Includes import raster_blocks
 
-arcpy.CheckOutExtension("Spatial")
+# Legacy bathN rasters (with the level index they are made from), the level index raster alone, or
+# every mask bit packed into one DepthMaskStack
+OUTPUT_FORMATS = ["Depth masks", "Level index", "Packed mask stack"]
 
 
 class DeepSeaSDMToolsExtractDepths(object):
@@ -53,6 +59,17 @@ class DeepSeaSDMToolsExtractDepths(object):
                                            )
         output_directory.value = r"D:\Example\DeepSeaSDMToolsExtractDepths\Depths"
         params.append(output_directory)
+
+        output_format = arcpy.Parameter(name="output_format",
+                                        displayName="Output format",
+                                        datatype="GPString",
+                                        parameterType="Optional",
+                                        direction="Input",
+                                        )
+        output_format.filter.type = "ValueList"
+        output_format.filter.list = OUTPUT_FORMATS
+        output_format.value = OUTPUT_FORMATS[0]
+        params.append(output_format)
         return params
 
     def isLicensed(self):
@@ -74,36 +91,58 @@ class DeepSeaSDMToolsExtractDepths(object):
         input_bathymetry = parameters[0].valueAsText
         output_directory = parameters[2].valueAsText
         depths = parameters[1].valueAsText
+        output_format = parameters[3].valueAsText or OUTPUT_FORMATS[0]
 
         if not os.path.exists(output_directory):
             os.makedirs(output_directory)
 
         arcpy.AddMessage("Extracting depths from " + str(input_bathymetry) + ".")
 
-        depth_list = load_depth_string(depths)
-
-        arcpy.AddMessage("Depths are: " + str(depth_list))
-
-        # Set environment variables for processing
-        env.mask = input_bathymetry
-        env.cellSize = input_bathymetry
-        extraster = arcpy.Raster(input_bathymetry)
-        extent1 = extraster.extent
-        env.extent = extent1
-        env.workspace = output_directory
-
-        # Conduct the extraction process
-
-        # Loop through each depth in the Depths list
-        for item in depth_list:
-            individual_depth = int(float(item))
-            null_value_clause = "VALUE > " + "-" + str(individual_depth)
-            arcpy.AddMessage("Processing depth: " + str(individual_depth))
-            output_set_null = SetNull(input_bathymetry, "1", null_value_clause)
-            output_set_null_2 = ApplyEnvironment(output_set_null)
-            output_set_null_2.save(os.path.join(output_directory, "bath" + str(individual_depth)))
+        depth_levels = DepthLevels.get(depths)
+        no_data_value = 349000000.0
+
+        arcpy.AddMessage("Depths are: " + str([int(depth) for depth in depth_levels]))
+
+        # Classify every cell by the deepest level it reaches in a single pass over the bathymetry,
+        # strip by strip so memory stays bounded on large grids
+        grid = GridDescriptor.from_raster(input_bathymetry)
+        index_blocks = ((row_offset, depth_level_index(values, depth_levels, no_data_value))
+                        for row_offset, values in raster_blocks(input_bathymetry, no_data_value, grid=grid))
+        spatial_reference = arcpy.Describe(input_bathymetry).spatialReference
+
+        if output_format == "Packed mask stack":
+            mask_stack = os.path.join(output_directory, "bathmasks")
+            arcpy.AddMessage("Packing the depth masks into " + str(mask_stack))
+            DepthMaskStack.build(mask_stack, depth_levels, grid, index_blocks, spatial_reference.exportToString())
+            return
+
+        index_raster = os.path.join(output_directory, "bathindex")
+        arcpy.AddMessage("Classifying depths into " + str(index_raster))
+        writers = [RasterBlockWriter(index_raster, grid, spatial_reference, -1)]
+
+        # Every depth mask is written from the same strips as the level index, cells reaching level k
+        # are those with an index of k or more (1, NoData elsewhere)
+        masks = []
+        if output_format == "Depth masks":
+            masks = [os.path.join(output_directory, "bath" + str(int(item))) for item in depth_levels]
+            writers += [RasterBlockWriter(mask, grid, spatial_reference, 0) for mask in masks]
+        try:
+            for row_offset, level_index in index_blocks:
+                writers[0].write(row_offset, level_index)
+                for level, writer in enumerate(writers[1:]):
+                    writer.write(row_offset, (level_index >= level).astype(np.uint8))
+        except:
+            for writer in writers:
+                writer.abort()
+            raise
+        for writer in writers:
+            writer.close()
+        depth_levels.save(index_raster + ".json")
+
+        for mask in masks:
+            arcpy.AddMessage("Building pyramids for " + str(mask))
             arcpy.env.pyramid = "PYRAMIDS 3 BILINEAR JPEG"
-            arcpy.BuildPyramids_management(os.path.join(output_directory, "bath" + str(individual_depth)))
+            arcpy.BuildPyramids_management(mask)
         return
 
 
@@ -5,9 +5,8 @@ from arcpy import env
 from Includes import load_depth_string
 from Includes import NetCDFFile
 from Includes import raster_to_xyz
-import pandas as pd
+from Includes import GridDescriptor
 import gc
-import numpy as np
 import time
 
 gc.enable()
@@ -327,66 +326,27 @@ class DeepSeaSDMToolsExtractWOANetCDF(object):
                     os.makedirs(os.path.join(output_directory, "Geographic_yxz"))
                 raster_to_xyz(os.path.join(output_directory, "Geographic", variable_name[0:4] + str(int(i))),
                               variable_name[0:4] + str(int(i)),
-                              os.path.join(output_directory, "Geographic_yxz"), 349000000.0)
-                depth = int(filter(str.isdigit, str(i)))
+                              os.path.join(output_directory, "Geographic_yxz"), 349000000.0,
+                              binary=True, skip_no_data=False, coordinates=False)
 
                 if count_geo == 0:
-                    df = pd.read_csv(os.path.join(output_directory, "Geographic_yxz", variable_name[0:4] + str(int(i)) + ".yxz"),
-                                     header=0, names=["y", "x", "z"], sep=" ", dtype={"y": np.float64,  "x": np.float64, "z": np.float64})
-                    master = df[["x", "y", "z"]].copy()
-                    master.columns = ["x", "y", int(depth)]
-                    master.to_pickle(os.path.join(output_directory, "Geographic_yxz", "master.pkl"))
-                    os.remove(os.path.join(output_directory, "Geographic_yxz", variable_name[0:4] + str(int(i)) + ".yxz"))
-                    del df, master
-                    gc.collect()
+                    GridDescriptor.from_raster(os.path.join(output_directory, "Geographic", variable_name[0:4] + str(int(i)))).save(
+                        os.path.join(output_directory, "Geographic_yxz", "grid.json"))
                     count_geo = 1
-                if count_geo == 1:
-                    master = pd.read_pickle(os.path.join(output_directory, "Geographic_yxz", "master.pkl"))
-                    df = pd.read_csv(os.path.join(output_directory, "Geographic_yxz", variable_name[0:4] + str(int(i)) + ".yxz"),
-                                     header=0, names=["y", "x", "z"], sep=" ", dtype={"y": np.float64,  "x": np.float64, "z": np.float64})
-                    master[int(depth)] = df["z"].copy()
-                    master.to_pickle(os.path.join(output_directory, "Geographic_yxz", "master.pkl"))
-                    os.remove(os.path.join(output_directory, "Geographic_yxz", variable_name[0:4] + str(int(i)) + ".yxz"))
-                    del df, master
-                    gc.collect()
 
             if createxyz == "Only Projected" or createxyz == "Both":
                 if not os.path.exists(os.path.join(output_directory, "Projected_yxz")):
                     os.makedirs(os.path.join(output_directory, "Projected_yxz"))
                 raster_to_xyz(os.path.join(output_directory, "Projected", variable_name[0:4] + str(int(i))),
                               variable_name[0:4] + str(int(i)),
-                              os.path.join(output_directory, "Projected_yxz"), 349000000.0)
-
-                depth = int(filter(str.isdigit, str(i)))
+                              os.path.join(output_directory, "Projected_yxz"), 349000000.0,
+                              binary=True, skip_no_data=False, coordinates=False)
 
                 if count_proj == 0:
-                    df = pd.read_csv(os.path.join(output_directory, "Projected_yxz", variable_name[0:4] + str(int(i)) + ".yxz"),
-                                     header=0, names=["y", "x", "z"], sep=" ", dtype={"y": np.float64,  "x": np.float64, "z": np.float64})
-                    master = df[["x", "y"]].copy()
-                    master.columns = ["x", "y"]
-                    master = np.round(master, 4)
-                    master.to_pickle(os.path.join(output_directory, "Projected_yxz", "xy_coords.pkl"))
-                    master.to_pickle(os.path.join(output_directory, "Projected", "xy_coords.pkl"))
-                    del master
-                    gc.collect()
-                    master_z = df[["z"]].copy()
-                    master_z.columns = [int(depth)]
-                    master_z = np.round(master_z, 4)
-                    master_z.to_pickle(os.path.join(output_directory, "Projected_yxz", str(int(i)) + ".pkl"))
-                    os.remove(os.path.join(output_directory, "Projected_yxz", variable_name[0:4] + str(int(i)) + ".yxz"))
-                    del df, master_z
-                    gc.collect()
+                    grid = GridDescriptor.from_raster(os.path.join(output_directory, "Projected", variable_name[0:4] + str(int(i))))
+                    grid.save(os.path.join(output_directory, "Projected_yxz", "grid.json"))
+                    grid.save(os.path.join(output_directory, "Projected", "grid.json"))
                     count_proj = 1
-                elif count_proj == 1:
-                    df = pd.read_csv(os.path.join(output_directory, "Projected_yxz", variable_name[0:4] + str(int(i)) + ".yxz"),
-                                     header=0, names=["y", "x", "z"], sep=" ", dtype={"y": np.float64,  "x": np.float64, "z": np.float64})
-                    master_z = df[["z"]].copy()
-                    master_z.columns = [int(depth)]
-                    master_z = np.round(master_z, 4)
-                    master_z.to_pickle(os.path.join(output_directory, "Projected_yxz", str(int(i)) + ".pkl"))
-                    os.remove(os.path.join(output_directory, "Projected_yxz", variable_name[0:4] + str(int(i)) + ".yxz"))
-                    del df, master_z
-                    gc.collect()
 
         arcpy.AddMessage("Making pyramids and statistics for outputs")
         arcpy.BuildPyramidsandStatistics_management(in_workspace=os.path.join(output_directory, "Geographic"), include_subdirectories="NONE",
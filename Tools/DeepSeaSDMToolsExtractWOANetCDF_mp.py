@@ -1,30 +1,152 @@
 # !/usr/bin/env python
 import arcpy
 import os
+import shutil
 from arcpy import env
 from Includes import load_depth_string
 from Includes import NetCDFFile
 from Includes import raster_to_xyz
-import pandas as pd
+from Includes import GridDescriptor
+from Includes import NetCDFSlabReader
+from Includes import array_to_raster
+from Includes import IDWInterpolator
+from Includes import KrigingInterpolator
+from Includes import SplineInterpolator
+from Includes import worker_pool
+from Includes import POOL_METHODS
+from Includes import longest_first
+from Includes import WorkerUtilization
+from Includes import staging_name
+from Includes import publish_raster
+from Includes import build_pyramids_and_statistics
+from Includes import TaskResult
+from Includes import RunManifest
+from Includes import split_multivalue
+from Includes import TemporalAggregator
+from Includes import DataCube
+from Includes import raster_blocks
 import gc
 import numpy as np
 import time
 import multiprocessing
 from functools import partial
-import shutil
-import sys
+import threading
+import traceback
+from collections import OrderedDict
 
 gc.enable()
 
 arcpy.CheckOutExtension("Spatial")
 
 
-def mpprocess_call(output_directory, variable_name, input_woa_netcdf, interpolation_procedure,
-                   interpolation_resolution, coordinate_system, createxyz, extraction_extent, depth_range):
-    DeepSeaSDMToolsExtractWOANetCDF_mp.mpprocess(output_directory, variable_name, input_woa_netcdf,
-                                                 interpolation_procedure,
-                                                 interpolation_resolution, coordinate_system, createxyz,
-                                                 extraction_extent, depth_range)
+# Readers and interpolator of each worker, thread local so that a thread pool gives every thread its own
+worker_state = threading.local()
+
+
+def build_interpolator(grid, interpolation_procedure, interpolation_resolution, extraction_extent):
+    # The WOA grid nodes are the same at every depth, so the IDW weights and the kriging and spline
+    # systems are worked out once and reused for each depth
+    if interpolation_procedure == "None":
+        return None, grid
+
+    source_y, source_x = grid.coordinates()
+    grid = GridDescriptor.from_extent(grid.intersect(extraction_extent), interpolation_resolution)
+    if interpolation_procedure == "IDW":
+        return IDWInterpolator(source_x, source_y, grid, 2, 10), grid
+    elif interpolation_procedure == "Kriging":
+        return KrigingInterpolator(source_x, source_y, grid, 10), grid
+    else:
+        return SplineInterpolator(source_x, source_y, grid, 0.1, 10), grid
+
+
+def init_worker(input_files, extraction_extent, interpolation_procedure, interpolation_resolution):
+    # The variables share one grid, so the interpolator is built once from the first of them and the
+    # other readers are opened as their tasks come along.  An exception here would only make the pool
+    # start the worker again, so keep it for the tasks
+    worker_state.error = None
+    worker_state.input_files = input_files
+    worker_state.extraction_extent = extraction_extent
+    worker_state.readers = {}
+    try:
+        reader = worker_reader(list(input_files.keys())[0])
+        worker_state.interpolator, worker_state.grid = build_interpolator(reader.grid,
+                                                                          interpolation_procedure,
+                                                                          interpolation_resolution,
+                                                                          extraction_extent)
+    except Exception:
+        worker_state.error = traceback.format_exc()
+
+
+def worker_reader(variable_name):
+    if variable_name not in worker_state.readers:
+        worker_state.readers[variable_name] = NetCDFSlabReader(worker_state.input_files[variable_name],
+                                                               variable_name, worker_state.extraction_extent)
+    return worker_state.readers[variable_name]
+
+
+# How a time dimension (monthly or seasonal climatologies) is handled
+TIME_HANDLING = ["First time step", "Each time step", "Aggregate time steps", "Each time step and aggregates"]
+
+# Whether the layers are also gathered into a depth x y x x DataCube per variable
+DATACUBE = ["None", "Uncompressed", "Compressed"]
+
+
+def mpprocess_call(output_directory, interpolation_procedure, interpolation_resolution, coordinate_system,
+                   extraction_extent, createxyz, time_handling, time_statistics, task):
+    # Time steps are read, interpolated and written one at a time, the aggregates are kept as running
+    # totals, so only one layer of the depth is held at any time
+    variable_name, depth = task
+    result = TaskResult(task)
+    try:
+        if worker_state.error is not None:
+            raise RuntimeError("Worker set up failed:\n" + worker_state.error)
+        reader = worker_reader(variable_name)
+
+        if time_handling == TIME_HANDLING[0] or reader.time_count < 2:
+            steps, each_step, aggregator = [None], True, None
+        else:
+            steps = range(reader.time_count)
+            each_step = time_handling in (TIME_HANDLING[1], TIME_HANDLING[3])
+            aggregator = TemporalAggregator() if time_handling in (TIME_HANDLING[2], TIME_HANDLING[3]) else None
+
+        for time_index in steps:
+            step = "" if time_index is None else " time step " + str(time_index + 1)
+            result.stage("Reading " + variable_name + " depth " + str(int(depth)) + step)
+            depth_values = reader.read_depth(depth, time_index)
+            if worker_state.interpolator is not None:
+                result.stage("Interpolating " + str(int(depth)) + step + " using " + interpolation_procedure)
+                depth_values = worker_state.interpolator.interpolate(depth_values)
+            if aggregator is not None:
+                aggregator.add(depth_values)
+            if each_step:
+                DeepSeaSDMToolsExtractWOANetCDF_mp.mpprocess(output_directory, variable_name,
+                                                             worker_state.input_files[variable_name],
+                                                             interpolation_procedure,
+                                                             interpolation_resolution, coordinate_system,
+                                                             extraction_extent, createxyz, depth, depth_values,
+                                                             worker_state.grid, result,
+                                                             "" if time_index is None else "t" + str(time_index + 1))
+                if result.failed:
+                    return result
+
+        if aggregator is not None:
+            for statistic in time_statistics:
+                result.stage("Aggregating " + variable_name + " depth " + str(int(depth)) + " " + statistic)
+                DeepSeaSDMToolsExtractWOANetCDF_mp.mpprocess(output_directory, variable_name,
+                                                             worker_state.input_files[variable_name],
+                                                             interpolation_procedure,
+                                                             interpolation_resolution, coordinate_system,
+                                                             extraction_extent, createxyz, depth,
+                                                             aggregator.result(statistic), worker_state.grid,
+                                                             result, TemporalAggregator.SUFFIXES[statistic])
+                if result.failed:
+                    return result
+    except Exception:
+        arcpy.AddMessage("Failed on " + variable_name + " " + str(int(depth)) + ",at status: " + result["stage"])
+        result.fail()
+        return result
+
+    return result.finish()
 
 
 class DeepSeaSDMToolsExtractWOANetCDF_mp(object):
@@ -46,19 +168,21 @@ class DeepSeaSDMToolsExtractWOANetCDF_mp(object):
         params = []
 
         input_woa_netcdf = arcpy.Parameter(name="input_woa_netcdf",
-                                           displayName="Input WOA NetCDF file",
+                                           displayName="Input WOA NetCDF file(s), one per variable or one for all",
                                            datatype="DEFile",
                                            parameterType="Required",
                                            direction="Input",
+                                           multiValue=True,
                                            )
         input_woa_netcdf.value = "D:\WOA\silicate\woa13_all_i00_01.nc"
         params.append(input_woa_netcdf)
 
-        variable_name = arcpy.Parameter(displayName="Variable",
+        variable_name = arcpy.Parameter(displayName="Variable(s)",
                                         name="variable_name",
                                         datatype="GPString",
                                         parameterType="Required",
-                                        direction="Input")
+                                        direction="Input",
+                                        multiValue=True)
         variable_name.value = "i_an"
         params.append(variable_name)
 
@@ -142,20 +266,65 @@ class DeepSeaSDMToolsExtractWOANetCDF_mp(object):
         params.append(cpu_cores_used)
         cpu_cores_used.value = "10"
 
+        pool_method = arcpy.Parameter(name="pool_method",
+                                      displayName="Worker pool (process start method)",
+                                      datatype="GPString",
+                                      parameterType="Optional",
+                                      direction="Input",
+                                      )
+        pool_method.filter.type = "ValueList"
+        pool_method.filter.list = POOL_METHODS
+        pool_method.value = "Default"
+        params.append(pool_method)
+
+        time_handling = arcpy.Parameter(name="time_handling",
+                                        displayName="Time steps (monthly or seasonal files)",
+                                        datatype="GPString",
+                                        parameterType="Optional",
+                                        direction="Input",
+                                        )
+        time_handling.filter.type = "ValueList"
+        time_handling.filter.list = TIME_HANDLING
+        time_handling.value = TIME_HANDLING[0]
+        params.append(time_handling)
+
+        time_statistics = arcpy.Parameter(name="time_statistics",
+                                          displayName="Aggregates across time steps",
+                                          datatype="GPString",
+                                          parameterType="Optional",
+                                          direction="Input",
+                                          multiValue=True,
+                                          )
+        time_statistics.filter.type = "ValueList"
+        time_statistics.filter.list = TemporalAggregator.STATISTICS
+        time_statistics.value = ";".join(TemporalAggregator.STATISTICS)
+        params.append(time_statistics)
+
+        datacube = arcpy.Parameter(name="datacube",
+                                   displayName="Also write a depth x y x x datacube per variable",
+                                   datatype="GPString",
+                                   parameterType="Optional",
+                                   direction="Input",
+                                   )
+        datacube.filter.type = "ValueList"
+        datacube.filter.list = DATACUBE
+        datacube.value = DATACUBE[0]
+        params.append(datacube)
+
         return params
 
     def updateParameters(self, parameters):
         """Modify the values and properties of parameters before internal
         validation is performed.  This method is called whenever a parameter
         has been changed."""
-        netCDFSource = parameters[0].valueAsText
-
-        if netCDFSource is not None:
+        variables = []
+        for netCDFSource in split_multivalue(parameters[0].valueAsText):
             # Making sure that the layers source is a netCDF file
             if NetCDFFile.isNetCDF(netCDFSource):
                 netCDFFile = NetCDFFile(netCDFSource)
-                variables = netCDFFile.getVariables()
-                parameters[1].filter.list = variables
+                variables += [variable for variable in netCDFFile.getVariables() if variable not in variables]
+        if variables:
+            parameters[1].filter.list = variables
         return
 
     def isLicensed(self):
@@ -167,9 +336,11 @@ class DeepSeaSDMToolsExtractWOANetCDF_mp(object):
         parameter.  This method is called after internal validation."""
         try:
 
-            netCDFSource = parameters[0].valueAsText
+            # Workers call arcpy, so threads are never offered, nor start methods this Python lacks
+            if parameters[10].valueAsText and parameters[10].valueAsText not in POOL_METHODS:
+                parameters[10].setErrorMessage("Choose one of " + ", ".join(POOL_METHODS) + ".")
 
-            if netCDFSource is not None:
+            for netCDFSource in split_multivalue(parameters[0].valueAsText):
                 # Making sure that the layers source is a netCDF file
                 if not NetCDFFile.isNetCDF(netCDFSource):
                     parameters[0].setErrorMessage("Invalid input file. "
@@ -181,118 +352,132 @@ class DeepSeaSDMToolsExtractWOANetCDF_mp(object):
 
     @staticmethod
     def mpprocess(output_directory, variable_name, input_woa_netcdf, interpolation_procedure,
-                  interpolation_resolution, coordinate_system, extraction_extent, createxyz, depth_range):
+                  interpolation_resolution, coordinate_system, extraction_extent, createxyz, depth_range,
+                  depth_values, grid, result=None, suffix=""):
+        # Writes one layer of the depth (suffix tells time steps and aggregates apart) and adds it to
+        # the layers of result
+        i = depth_range
+        result = TaskResult((variable_name, i)) if result is None else result
+        name = variable_name[0:4].lower() + str(int(i)) + suffix
         try:
-            i = depth_range
+            arcpy.env.extent = extraction_extent
 
-            status = "Started"
+            arcpy.AddMessage("Processing depth: " + str(int(i)) + " (" + name + ")")
 
-            arcpy.env.extent = extraction_extent
+            staged_geographic = DeepSeaSDMToolsExtractWOANetCDF_mp.staged_raster(output_directory, name)
+            output_xyz = os.path.join(output_directory, "Geographic_yxz", name + ".xyz")
+            if not os.path.exists(os.path.dirname(staged_geographic)):
+                os.makedirs(os.path.dirname(staged_geographic))
 
-            arcpy.AddMessage("Processing depth: " + str(int(i)))
-
-            out_temp_layer = variable_name[0:4] + str(int(i)) + ".shp"
-            dimensionValues = "depth " + str(int(i))
-
-            output_dir_geographic = os.path.join(output_directory, "temp", "Geographic",
-                                                 variable_name[0:4] + str(int(i)))
-            output_geographic = os.path.join(output_dir_geographic, variable_name[0:4] + str(int(i)))
-
-            output_dir_projected = os.path.join(output_directory, "temp", "Projected", variable_name[0:4] + str(int(i)))
-            output_projected = os.path.join(output_dir_projected, variable_name[0:4] + str(int(i)))
-
-            if not os.path.exists(os.path.join(output_dir_projected, "xy_coords.yxz")) or os.path.exists(
-                    os.path.join(output_dir_geographic, "xy_coords.yxz")):
-
-                if not os.path.exists(output_dir_geographic):
-                    os.makedirs(output_dir_geographic)
-
-                if not os.path.exists(output_dir_projected):
-                    os.makedirs(output_dir_projected)
-
-                env.workspace = os.path.join(output_directory, "temp", variable_name[0:4] + str(int(i)))
-
-                # 1 Extract layer to a temporary feature class
-                arcpy.MakeNetCDFFeatureLayer_md(in_netCDF_file=input_woa_netcdf, variable=variable_name,
-                                                x_variable="lon",
-                                                y_variable="lat",
-                                                out_feature_layer=out_temp_layer,
-                                                row_dimension="lat;lon",
-                                                z_variable="", m_variable="", dimension_values=dimensionValues,
-                                                value_selection_method="BY_VALUE")
-
-                # 2 Interpolate to higher resolution and 3 save to output directory
-                if interpolation_procedure == "IDW":
-                    status = "Interpolating " + str(int(i)) + " using IDW"
-                    arcpy.gp.Idw_sa(out_temp_layer, variable_name, output_geographic,
-                                    interpolation_resolution, "2", "VARIABLE 10", "")
-                elif interpolation_procedure == "Spline":
-                    status = "Interpolating " + str(int(i)) + " using Spline"
-                    arcpy.CopyFeatures_management(out_temp_layer, os.path.join(output_dir_geographic, "out.shp"))
-                    arcpy.gp.Spline_sa(out_temp_layer, variable_name, output_geographic,
-                                       interpolation_resolution, "TENSION", "0.1", "10")
-                    arcpy.Delete_management(
-                        os.path.join(output_directory, "temp", "Geographic", variable_name[0:4] + str(int(i)),
-                                     "out.shp"))
-                elif interpolation_procedure == "Kriging":
-                    status = "Interpolating " + str(int(i)) + " using Ordinary Kriging"
-                    arcpy.gp.Kriging_sa(out_temp_layer, variable_name,
-                                        output_geographic,
-                                        "Spherical " + str(interpolation_resolution), interpolation_resolution,
-                                        "VARIABLE 10", "")
-
-                elif interpolation_procedure == "None":
-                    status = "Making a raster for " + str(int(i))
-                    arcpy.MakeNetCDFRasterLayer_md(in_netCDF_file=input_woa_netcdf, variable=variable_name,
-                                                   x_dimension="lon", y_dimension="lat",
-                                                   out_raster_layer=output_geographic,
-                                                   band_dimension="", dimension_values="",
-                                                   value_selection_method="BY_VALUE")
-
-                if len(coordinate_system) > 1:
-                    status = "Reprojecting " + variable_name[0:4] + str(int(i)) + "."
-                    arcpy.ProjectRaster_management(output_geographic,
-                                                   output_projected,
-                                                   coordinate_system, "NEAREST", "#", "#", "#", "#")
-
-                if createxyz == "Only Geographic" or createxyz == "Both":
-                    status = "Building geographic xy coords for " + variable_name[0:4] + str(int(i)) + "."
-                    raster_to_xyz(output_geographic,
-                                  variable_name[0:4] + str(int(i)),
-                                  output_dir_geographic,
-                                  349000000.0)
-
-                    df = pd.read_csv(os.path.join(output_dir_geographic, variable_name[0:4] + str(int(i)) + ".yxz"),
-                                     header=0, names=["y", "x", "z"], sep=" ",
-                                     dtype={"y": np.float32, "x": np.float32, "z": np.float32})
-                    master = df[["x", "y"]].copy()
-                    master.columns = ["x", "y"]
-                    master = np.round(master, 4)
-                    master.to_pickle(os.path.join(output_dir_geographic, "xy_coords.yxz"))
-                    del master, df
-                    gc.collect()
-
-                if createxyz == "Only Projected" or createxyz == "Both":
-                    status = "Building projected xy coords for " + variable_name[0:4] + str(int(i)) + "."
-                    raster_to_xyz(output_projected,
-                                  variable_name[0:4] + str(int(i)),
-                                  output_dir_projected,
-                                  349000000.0)
-
-                    df = pd.read_csv(os.path.join(output_dir_projected, variable_name[0:4] + str(int(i)) + ".yxz"),
-                                     header=0, names=["y", "x", "z"], sep=" ",
-                                     dtype={"y": np.float32, "x": np.float32, "z": np.float32})
-                    master = df[["x", "y"]].copy()
-                    master.columns = ["x", "y"]
-                    master = np.round(master, 4)
-                    master.to_pickle(os.path.join(output_dir_projected, "xy_coords.yxz"))
-                    del master, df
-                    gc.collect()
+            # 1 Interpolate to higher resolution and 2 save as a GeoTIFF in a folder of its own, workers
+            # never write into the Geographic workspace as concurrent writes corrupt the info folder its
+            # grids share.  postprocess moves it there from the main process
+            if interpolation_procedure == "None":
+                result.stage("Making a raster for " + str(int(i)))
             else:
-                arcpy.AddMessage("Skipping " + str(int(i)) + ".")
+                # Already interpolated by the shared interpolator in execute
+                result.stage("Saving " + interpolation_procedure + " interpolation of " + str(int(i)))
+            array_to_raster(depth_values, grid, staged_geographic, arcpy.SpatialReference(4326))
+
+            # The dataset is only added to the outputs of the result once written, so the run
+            # manifest never takes a half written one for done
+            if createxyz == "Only Geographic" or createxyz == "Both":
+                result.stage("Building geographic xy coords for " + name + ".")
+                raster_to_xyz(staged_geographic,
+                              name,
+                              os.path.dirname(output_xyz),
+                              349000000.0, binary=True, skip_no_data=False, coordinates=False)
+                result.output(output_xyz)
+            result.setdefault("layers", []).append(name)
         except:
-            arcpy.AddMessage("Failed on " + str(int(i)) + ",at status: " + str(status))
+            arcpy.AddMessage("Failed on " + name + ",at status: " + str(result["stage"]))
             arcpy.AddMessage(arcpy.GetMessages())
+            result.fail()
+        return result
+
+    @staticmethod
+    def staged_raster(output_directory, name):
+        # Where a worker writes a layer before postprocess moves it into Geographic
+        return os.path.join(output_directory, "Staging", name, name + ".tif")
+
+    @staticmethod
+    def postprocess(output_directory, coordinate_system, createxyz, result, datacube="None", levels=None):
+        # Runs in the main process on each depth as the workers hand it back, while they go on with
+        # the next depths
+        variable_name, depth = result["task"]
+        if result.failed:
+            return result
+        try:
+            for name in result.get("layers", []):
+                DeepSeaSDMToolsExtractWOANetCDF_mp.postprocess_layer(output_directory, coordinate_system, createxyz,
+                                                                     result, name)
+                if datacube != "None":
+                    # The depth layers of each variable (and time step or aggregate) go into one cube,
+                    # only ever written from here, so workers never touch the same chunk.  Depths come
+                    # back in any order, one at a time, so each level is a chunk of its own rather than
+                    # rewriting a chunk of several levels for each of them
+                    series = variable_name[0:4].lower() + name[len(variable_name[0:4] + str(int(depth))):]
+                    for projection in ["Geographic", "Projected"]:
+                        raster = os.path.join(output_directory, projection, name)
+                        if projection == "Projected" and len(coordinate_system) <= 1:
+                            continue
+                        result.stage("Adding " + name + " to the " + projection + " datacube.")
+                        grid = GridDescriptor.from_raster(raster)
+                        values = np.empty(grid.shape, dtype=np.float32)
+                        for row, block in raster_blocks(raster, 349000000.0, grid=grid):
+                            values[row:row + block.shape[0]] = np.where(block == 349000000.0, np.nan, block)
+                        cube = DataCube.create(os.path.join(output_directory, projection + "_cube", series), levels,
+                                               grid, chunks=(1, 256, 256), compress=datacube == "Compressed")
+                        if cube.rebuilt:
+                            result.setdefault("rebuilt", []).append(cube.path)
+                        cube.write_level(depth, values)
+                        result.output(cube.path)
+        except:
+            arcpy.AddMessage("Failed post-processing " + variable_name + " " + str(int(depth)) + ",at status: " + str(result["stage"]))
+            arcpy.AddMessage(arcpy.GetMessages())
+            result.fail()
+        return result.finish()
+
+    @staticmethod
+    def postprocess_layer(output_directory, coordinate_system, createxyz, result, name):
+        output_geographic = os.path.join(output_directory, "Geographic", name)
+        output_projected = os.path.join(output_directory, "Projected", name)
+
+        # Layers are moved into the Geographic workspace one at a time, only from the main process
+        staged_geographic = DeepSeaSDMToolsExtractWOANetCDF_mp.staged_raster(output_directory, name)
+        result.stage("Moving " + name + " into Geographic.")
+        arcpy.CopyRaster_management(staged_geographic, staging_name(output_geographic))
+        result.output(publish_raster(staging_name(output_geographic), output_geographic))
+        arcpy.Delete_management(staged_geographic)
+        shutil.rmtree(os.path.dirname(staged_geographic), ignore_errors=True)
+
+        outputs = [("Geographic", output_geographic, createxyz == "Only Geographic" or createxyz == "Both")]
+
+        if len(coordinate_system) > 1:
+            result.stage("Reprojecting " + name + ".")
+            arcpy.ProjectRaster_management(output_geographic,
+                                           staging_name(output_projected),
+                                           coordinate_system, "NEAREST", "#", "#", "#", "#")
+            result.output(publish_raster(staging_name(output_projected), output_projected))
+
+            create_projected_xyz = createxyz == "Only Projected" or createxyz == "Both"
+            if create_projected_xyz:
+                result.stage("Building projected xy coords for " + name + ".")
+                raster_to_xyz(output_projected, name, os.path.join(output_directory, "Projected_yxz"),
+                              349000000.0, binary=True, skip_no_data=False, coordinates=False)
+                result.output(os.path.join(output_directory, "Projected_yxz", name + ".xyz"))
+            outputs.append(("Projected", output_projected, create_projected_xyz))
+
+        # Every depth shares one grid, so its coordinates are stored once as a grid descriptor
+        for projection, raster, create_xyz in outputs:
+            result.stage("Building pyramids and statistics for " + raster + ".")
+            build_pyramids_and_statistics(raster)
+
+            folders = [projection, projection + "_yxz"] if create_xyz else [projection]
+            for folder in folders:
+                grid_file = os.path.join(output_directory, folder, "grid.json")
+                if not os.path.exists(grid_file):
+                    GridDescriptor.from_raster(raster).save(grid_file)
 
     def execute(self, parameters, messages):
 
@@ -303,8 +488,8 @@ class DeepSeaSDMToolsExtractWOANetCDF_mp(object):
         for param in parameters:
             arcpy.AddMessage("Parameter: %s = %s" % (param.name, param.valueAsText))
 
-        input_woa_netcdf = parameters[0].valueAsText
-        variable_name = parameters[1].valueAsText
+        input_woa_netcdf = split_multivalue(parameters[0].valueAsText)
+        variable_names = split_multivalue(parameters[1].valueAsText)
         depths = parameters[2].valueAsText
         interpolation_procedure = parameters[3].valueAsText
         interpolation_resolution = parameters[4].valueAsText
@@ -313,6 +498,14 @@ class DeepSeaSDMToolsExtractWOANetCDF_mp(object):
         coordinate_system = parameters[7].valueAsText
         createxyz = parameters[8].valueAsText
         cpu_cores_used = parameters[9].valueAsText
+        pool_method = parameters[10].valueAsText or POOL_METHODS[0]
+        time_handling = parameters[11].valueAsText or TIME_HANDLING[0]
+        time_statistics = split_multivalue(parameters[12].valueAsText) or TemporalAggregator.STATISTICS
+        datacube = parameters[13].valueAsText or DATACUBE[0]
+
+        if pool_method not in POOL_METHODS:
+            raise Exception("The " + pool_method + " worker pool can not be used here, choose one of " +
+                            ", ".join(POOL_METHODS) + ".")
 
         if not os.path.exists(output_directory):
             os.makedirs(output_directory)
@@ -323,91 +516,110 @@ class DeepSeaSDMToolsExtractWOANetCDF_mp(object):
         if not os.path.exists(os.path.join(output_directory, "Geographic")):
             os.makedirs(os.path.join(output_directory, "Geographic"))
 
+        if not os.path.exists(os.path.join(output_directory, "Staging")):
+            os.makedirs(os.path.join(output_directory, "Staging"))
+
+        if (createxyz == "Only Geographic" or createxyz == "Both") and \
+                not os.path.exists(os.path.join(output_directory, "Geographic_yxz")):
+            os.makedirs(os.path.join(output_directory, "Geographic_yxz"))
+
+        if (createxyz == "Only Projected" or createxyz == "Both") and \
+                not os.path.exists(os.path.join(output_directory, "Projected_yxz")):
+            os.makedirs(os.path.join(output_directory, "Projected_yxz"))
+
         arcpy.env.extent = extraction_extent
 
-        arcpy.AddMessage("Extracting " + str(input_woa_netcdf) + ".")
+        # One file per variable, or one file holding all of them
+        if len(input_woa_netcdf) == 1:
+            input_woa_netcdf = input_woa_netcdf * len(variable_names)
+        if len(input_woa_netcdf) != len(variable_names):
+            raise Exception("Give one NetCDF file per variable, or one file for all of them.")
+        if len(set(variable_name[0:4].lower() for variable_name in variable_names)) != len(variable_names):
+            raise Exception("Outputs are named from the first four letters of the variable, these have to differ.")
+        input_files = OrderedDict(zip(variable_names, input_woa_netcdf))
+
+        for variable_name in variable_names:
+            arcpy.AddMessage("Extracting " + variable_name + " from " + str(input_files[variable_name]) + ".")
 
         # Set environment variables and build other variables for processing
         arcpy.env.mask = ""
         arcpy.env.workspace = output_directory
         depth_range = load_depth_string(depths)
 
-        arcpy.AddMessage("There are " + str(len(depth_range)) + " to process.")
+        # Depths done in an earlier run with the same input and settings, and whose outputs are still
+        # there, are not run again
+        manifest = RunManifest(os.path.join(output_directory, "run_manifest.json"),
+                               [interpolation_procedure, interpolation_resolution, extraction_extent, coordinate_system,
+                                createxyz, time_handling, time_statistics, datacube],
+                               lambda task: [RunManifest.input_signature(input_files[task[0]]), task[0]])
+        tasks = [(variable_name, depth) for variable_name in variable_names for depth in depth_range]
+        all_tasks = len(tasks)
+        tasks = manifest.pending(tasks)
+
+        arcpy.AddMessage("There are " + str(len(tasks)) + " variable depths to process, " +
+                         str(all_tasks - len(tasks)) + " already done.")
 
         if int(cpu_cores_used) > int(multiprocessing.cpu_count()):
             cpu_cores_used = multiprocessing.cpu_count() - 1
 
         arcpy.AddMessage("Will use " + str(cpu_cores_used) + " cores for processing")
 
-        python_exe = os.path.join(sys.exec_prefix, 'pythonw.exe')
-        multiprocessing.set_executable(python_exe)
-
-        pool = multiprocessing.Pool(int(cpu_cores_used))
-        func = partial(mpprocess_call, output_directory, variable_name, input_woa_netcdf, interpolation_procedure,
-                       interpolation_resolution, coordinate_system, extraction_extent, createxyz)
-        pool.map(func, depth_range)
+        # Shallow layers hold far more ocean cells than abyssal ones, so hand out the biggest depths
+        # first and one at a time, letting workers that finish early take the small ones.  The cells
+        # of each depth are estimated from a subsample, so this costs one small read per file.  The
+        # interpolator is shared by every variable, so they have to be on the same grid
+        variable_tasks = []
+        costs = []
+        grid = None
+        for variable_name in variable_names:
+            with NetCDFSlabReader(input_files[variable_name], variable_name, extraction_extent) as reader:
+                if grid is None:
+                    grid = reader.grid
+                elif reader.grid != grid:
+                    raise Exception(variable_name + " is not on the same grid as " + variable_names[0] + ".")
+                variable_tasks += [task for task in tasks if task[0] == variable_name]
+                costs += list(reader.valid_counts([depth for name, depth in tasks if name == variable_name]))
+        tasks = longest_first(variable_tasks, costs)
+
+        # Each worker builds the interpolator once, then opens each NetCDF file the first time it
+        # reads from it
+        pool = worker_pool(cpu_cores_used, pool_method, init_worker,
+                           (input_files, extraction_extent, interpolation_procedure, interpolation_resolution))
+        func = partial(mpprocess_call, output_directory, interpolation_procedure, interpolation_resolution,
+                       coordinate_system, extraction_extent, createxyz, time_handling, time_statistics)
+        utilization = WorkerUtilization(max(1, int(cpu_cores_used)))
+        completed = all_tasks - len(tasks)
+        failed = []
+        for result in pool.imap_unordered(func, tasks, 1):
+            utilization.record(result["worker"], result["start"], result["end"])
+            result = self.postprocess(output_directory, coordinate_system, createxyz, result, datacube, depth_range)
+            # A cube left by an earlier run with other settings was replaced, the depths that run
+            # wrote into it have to be done again
+            for cube_path in result.get("rebuilt", []):
+                manifest.forget(cube_path)
+                arcpy.AddMessage(cube_path + " was made anew, run the tool again to refill the depths "
+                                 "done by earlier runs.")
+            manifest.record(result)
+            manifest.save()
+            completed += 1
+            if result.failed:
+                failed.append(result)
+            arcpy.AddMessage("Finished " + result["task"][0] + " depth " + str(int(result["task"][1])) + " (" +
+                             str(completed) + " of " + str(all_tasks) + "), " + result["status"] + " in " +
+                             str(round(result["end"] - result["start"], 1)) + " s on " + result["worker"])
         pool.close()
         pool.join()
 
-        count = 0
+        arcpy.AddMessage("Worker utilization:")
+        for line in utilization.report():
+            arcpy.AddMessage(line)
 
-        depth_range = load_depth_string(depths)
-
-        for i in depth_range:
-            try:
-                output_geographic = os.path.join(output_directory, "temp", "Geographic",
-                                                 variable_name[0:4] + str(int(i)), variable_name[0:4] + str(int(i)))
-                if arcpy.Exists(output_geographic) and not arcpy.Exists(
-                        os.path.join(output_directory, "Geographic", variable_name[0:4] + str(int(i)))):
-                    shutil.copytree(output_geographic, os.path.join(output_directory, "Geographic",
-                                                                    variable_name[0:4].lower() + str(int(i))))
-            except:
-                arcpy.AddMessage("Issue copying, geographic for depth " + str(int(i)))
-
-            try:
-                output_projected = os.path.join(output_directory, "temp", "Projected", variable_name[0:4] + str(int(i)),
-                                                variable_name[0:4] + str(int(i)))
-                if arcpy.Exists(output_projected) and not arcpy.Exists(
-                        os.path.join(output_directory, "Projected", variable_name[0:4] + str(int(i)))):
-                    shutil.copytree(output_projected, os.path.join(output_directory, "Projected",
-                                                                   str(variable_name[0:4].lower() + str(int(i)))))
-            except:
-                arcpy.AddMessage("Issue copying, projected for depth " + str(int(i)))
-
-            try:
-                if count == 0:
-                    if os.path.exists(
-                            os.path.join(output_directory, "temp", "Projected", variable_name[0:4] + str(int(i)),
-                                         "xy_coords.yxz")):
-                        shutil.copyfile(
-                            os.path.join(output_directory, "temp", "Projected", variable_name[0:4] + str(int(i)),
-                                         "xy_coords.yxz"),
-                            os.path.join(output_directory, "Projected", "xy_coords.yxz"))
-                        count = 1
-            except:
-                arcpy.AddMessage("Issue copying, xyz coordiantes for depth " + str(int(i)))
-
-        arcpy.AddMessage("Making pyramids and statistics for outputs")
-        arcpy.BuildPyramidsandStatistics_management(in_workspace=os.path.join(output_directory, "Geographic"),
-                                                    include_subdirectories="NONE",
-                                                    build_pyramids="BUILD_PYRAMIDS",
-                                                    calculate_statistics="CALCULATE_STATISTICS", BUILD_ON_SOURCE="NONE",
-                                                    block_field="", estimate_statistics="NONE", x_skip_factor="1",
-                                                    y_skip_factor="1", ignore_values="", pyramid_level="-1",
-                                                    SKIP_FIRST="NONE", resample_technique="NEAREST",
-                                                    compression_type="DEFAULT", compression_quality="75",
-                                                    skip_existing="SKIP_EXISTING")
-        if len(coordinate_system) > 1:
-            arcpy.BuildPyramidsandStatistics_management(in_workspace=os.path.join(output_directory, "Projected"),
-                                                        include_subdirectories="NONE",
-                                                        build_pyramids="BUILD_PYRAMIDS",
-                                                        calculate_statistics="CALCULATE_STATISTICS",
-                                                        BUILD_ON_SOURCE="NONE",
-                                                        block_field="", estimate_statistics="NONE", x_skip_factor="1",
-                                                        y_skip_factor="1", ignore_values="", pyramid_level="-1",
-                                                        SKIP_FIRST="NONE", resample_technique="NEAREST",
-                                                        compression_type="DEFAULT", compression_quality="75",
-                                                        skip_existing="SKIP_EXISTING")
+        if failed:
+            for result in failed:
+                arcpy.AddMessage(result["task"][0] + " depth " + str(int(result["task"][1])) + " failed at status: " +
+                                 result["stage"] + "\n" + str(result["error"]))
+            raise Exception(str(len(failed)) + " of " + str(all_tasks) + " variable depths failed, see " +
+                            manifest.path + ". Run the tool again to retry only those depths.")
 
         arcpy.AddMessage("Script complete in %s hours." % str((time.clock() - t_start) / 3600))
 
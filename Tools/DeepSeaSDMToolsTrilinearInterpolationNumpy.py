@@ -0,0 +1,193 @@
+#!/usr/bin/env python
+import arcpy
+from Includes import DepthLevels
+from Includes import GridDescriptor
+from Includes import LayerStack
+from Includes import trilinear_interpolate
+from Includes import raster_blocks
+from Includes import RasterBlockWriter
+from Includes import worker_pool
+import numpy as np
+import multiprocessing
+import time
+
+arcpy.CheckOutExtension("Spatial")
+
+
+def interpolate_tile(stack, levels, row, col, depth):
+    # Runs in the thread pool, the stack window has already been read in the main thread
+    values = np.full(depth.shape, np.nan, dtype=np.float32)
+    ocean = np.isfinite(depth)
+    if ocean.any():
+        values[ocean] = trilinear_interpolate(stack, levels, row[ocean], col[ocean], depth[ocean])
+    return values
+
+
+class DeepSeaSDMToolsTrilinearInterpolationNumpy(object):
+    """This class has the methods you need to define
+       to use your code as an ArcGIS Python Tool."""
+
+    def __init__(self):
+        self.label = "Trilinear interpolation of depth layers onto bathymetry (NumPy)"
+        self.description = """Samples the depth layers extracted from a World Ocean Atlas NetCDF file at
+        the position and depth of every cell of a bathymetry raster.  Values are interpolated bilinearly
+        within the two depth layers either side of the seabed and linearly between them.  The depth layers
+        are the outputs of the WOA extraction tools, use the Geographic or Projected folder (or their _yxz
+        binary XYZ folders, or the datacube of the variable) that matches the coordinate system of the
+        bathymetry."""
+        self.canRunInBackground = True
+        self.category = "Deep-sea SDM Tools"  # Use your own category here, or an existing one.
+
+    def getParameterInfo(self):
+        params = []
+
+        input_bathymetry = arcpy.Parameter(name="input_bathymetry",
+                                           displayName="Input Bathymetry Raster",
+                                           datatype="DERasterDataset",
+                                           parameterType="Required",
+                                           direction="Input",
+                                           )
+        input_bathymetry.value = "D:\Example\DeepSeaSDMToolsExtractDepths\depth.tif"
+        params.append(input_bathymetry)
+
+        input_layers = arcpy.Parameter(name="input_layers",
+                                       displayName="Folder of extracted depth layers, or a datacube",
+                                       datatype="DEFolder",
+                                       parameterType="Required",
+                                       direction="Input",
+                                       )
+        input_layers.value = "D:\WOA/silicate/Projected_yxz"
+        params.append(input_layers)
+
+        variable_name = arcpy.Parameter(displayName="Variable",
+                                        name="variable_name",
+                                        datatype="GPString",
+                                        parameterType="Required",
+                                        direction="Input")
+        variable_name.value = "i_an"
+        params.append(variable_name)
+
+        depths = arcpy.Parameter(name="depths",
+                                 displayName="Select depths (WOA13v2, WOA05, Steinacher or Custom (in CSV style)",
+                                 datatype="GPString",
+                                 parameterType="Required",
+                                 direction="Input",
+                                 )
+        depths.value = "WOA13v2"
+        params.append(depths)
+
+        output_raster = arcpy.Parameter(name="output_raster",
+                                        displayName="Output Raster",
+                                        datatype="DERasterDataset",
+                                        parameterType="Required",
+                                        direction="Output",
+                                        )
+        output_raster.value = "D:\WOA/silicate/i_an_tri.tif"
+        params.append(output_raster)
+
+        cpu_cores_used = arcpy.Parameter(name="cpu_cores_used",
+                                         displayName="Number of CPU cores to use",
+                                         datatype="GPString",
+                                         parameterType="Required",
+                                         direction="Input",
+                                         )
+        cpu_cores_used.value = "4"
+        params.append(cpu_cores_used)
+
+        return params
+
+    def isLicensed(self):
+        """Set whether tool is licensed to execute."""
+        return True
+
+    def updateMessages(self, parameters):
+        """Modify the messages created by internal validation for each tool
+        parameter.  This method is called after internal validation."""
+        return
+
+    def execute(self, parameters, messages):
+
+        t_start = time.clock()
+
+        arcpy.env.overwriteOutput = True
+
+        for param in parameters:
+            arcpy.AddMessage("Parameter: %s = %s" % (param.name, param.valueAsText))
+
+        input_bathymetry = parameters[0].valueAsText
+        input_layers = parameters[1].valueAsText
+        variable_name = parameters[2].valueAsText
+        depths = parameters[3].valueAsText
+        output_raster = parameters[4].valueAsText
+        cpu_cores_used = min(int(parameters[5].valueAsText), multiprocessing.cpu_count())
+
+        levels = DepthLevels.get(depths)
+        stack = LayerStack(input_layers, variable_name[0:4].lower(), levels.depths)
+        if stack.missing:
+            arcpy.AddMessage("No layer found for depths " + str(stack.missing) + ", these are left out.")
+
+        bathymetry_grid = GridDescriptor.from_raster(input_bathymetry)
+
+        arcpy.AddMessage("Interpolating " + str(bathymetry_grid.rows) + " rows of " + str(input_bathymetry) +
+                         " using " + str(cpu_cores_used) + " threads.")
+
+        # Strips of the bathymetry are read, and the part of the stack under them, in this thread (arcpy
+        # is not thread safe), the interpolation of each strip then runs in the thread pool.  At most two
+        # strips per thread wait in the pool, so memory stays bounded.  Finished strips are written
+        # out in order as they come back, strips without ocean as NoData
+        pool = worker_pool(cpu_cores_used, "thread")
+        pending = []
+
+        def write_strip(writer, done_row, done_rows, result):
+            if result is None:
+                writer.write(done_row, np.full((done_rows, bathymetry_grid.cols), np.nan, dtype=np.float32))
+            else:
+                writer.write(done_row, result.get().reshape(done_rows, bathymetry_grid.cols))
+
+        with RasterBlockWriter(output_raster, bathymetry_grid,
+                               arcpy.Describe(input_bathymetry).spatialReference) as writer:
+            for row, values in raster_blocks(input_bathymetry, 349000000.0, 1048576, bathymetry_grid):
+                # Bathymetry is negative below sea level, land and NoData cells are left NaN
+                ocean = ((values != 349000000.0) & (values < 0)).ravel()
+                if not ocean.any():
+                    pending.append((row, values.shape[0], None))
+                    continue
+                depth = np.where(ocean, -values.astype(np.float64).ravel(), np.nan)
+                y, x = bathymetry_grid.block(row, row + values.shape[0])
+                stack_row, stack_col = stack.positions(x, y)
+
+                # Only the rows, columns and levels the strip falls in are read from the stack
+                window = [int(np.floor(stack_row[ocean].min())), int(np.ceil(stack_row[ocean].max())) + 1,
+                          int(np.floor(stack_col[ocean].min())), int(np.ceil(stack_col[ocean].max())) + 1]
+                window = [min(max(window[0], 0), stack.grid.rows - 1), min(max(window[1], 1), stack.grid.rows),
+                          min(max(window[2], 0), stack.grid.cols - 1), min(max(window[3], 1), stack.grid.cols)]
+                level_start = int(levels.bracket(depth[ocean].min())[0])
+                level_stop = int(levels.bracket(depth[ocean].max())[1]) + 1
+                level_stop = max(level_stop, level_start + 1)
+
+                pending.append((row, values.shape[0], pool.apply_async(
+                    interpolate_tile, (stack.read(window, level_start, level_stop),
+                                       levels.depths[level_start:level_stop],
+                                       stack_row - window[0], stack_col - window[2], depth))))
+
+                while len(pending) > 2 * cpu_cores_used:
+                    write_strip(writer, *pending.pop(0))
+
+            arcpy.AddMessage("Saving " + str(output_raster))
+            for done_row, done_rows, result in pending:
+                write_strip(writer, done_row, done_rows, result)
+        pool.close()
+        pool.join()
+
+        arcpy.AddMessage("Script complete in %s hours." % str((time.clock() - t_start) / 3600))
+
+        return
+
+
+def main():
+    tool = DeepSeaSDMToolsTrilinearInterpolationNumpy()
+    tool.execute(tool.getParameterInfo(), None)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,9 +1,22 @@
-import arcpy
 import time
 import numpy as np
-import csv
 import os
+import hashlib
 import gc
+import json
+import threading
+import sys
+import multiprocessing
+import traceback
+import shutil
+import tempfile
+from collections import OrderedDict
+
+try:
+    import arcpy
+except ImportError:
+    # The numpy helpers below (NetCDF reading, grids, XYZ files) also work without ArcGIS
+    arcpy = None
 
 # Reusable includes that are used by several programs
 #
@@ -31,47 +44,206 @@ import gc
 
 
 def load_depth_string(depth):
+    '''
+     Depth levels of a standard set (WOA05, Steinacher, WOA13v2, WOA18) or of a custom comma
+     separated list as strings ("0", "10", ...).  Custom lists are kept in the order given, repeats
+     and all, and a blank one gives no depths, as the extraction tools take them one by one.
+     DepthLevels gives the levels as numbers, sorted, for interpolating between them.
+    '''
+    if str(depth).strip() in DepthLevels.STANDARD:
+        return DepthLevels.get(depth).labels()
+    return [item.strip() for item in str(depth).split(",") if item.strip()]
+
+
+class DepthLevels(object):
+    '''
+     Registry of depth level sets.  DepthLevels.get(depth) returns one shared instance per standard
+     set (WOA05, Steinacher, WOA13v2, WOA18) or custom comma separated list, built once per process,
+     with the levels as a read only ascending float64 array in depths.  Lookups are binary searches
+     and take a single depth or an array of them, so layers can be picked for every cell of a raster
+     in one call.
+    '''
+
+    STANDARD = {
+        "WOA05": (0, 10, 20, 30, 50, 75, 100, 125, 150, 200, 250, 300, 400, 500, 600, 700, 800, 900, 1000,
+                  1100, 1200, 1300, 1400, 1500, 1750, 2000, 2500, 3000, 3500, 4000, 4500, 5000, 5500),
+        "Steinacher": (6, 19, 38, 62, 93, 133, 183, 245, 322, 415, 527, 661, 818, 1001, 1211, 1449, 1717, 2014,
+                       2340, 2693, 3072, 3473, 3894, 4329, 4775),
+        "WOA13v2": (0, 5, 10, 15, 20, 25, 30, 35, 40, 45, 50, 55, 60, 65, 70, 75, 80, 85, 90, 95, 100, 125,
+                    150, 175, 200, 225, 250, 275, 300, 325, 350, 375, 400, 425, 450, 475, 500, 550, 600, 650,
+                    700, 750, 800, 850, 900, 950, 1000, 1050, 1100, 1150, 1200, 1250, 1300, 1350, 1400, 1450,
+                    1500, 1550, 1600, 1650, 1700, 1750, 1800, 1850, 1900, 1950, 2000, 2100, 2200, 2300, 2400,
+                    2500, 2600, 2700, 2800, 2900, 3000, 3100, 3200, 3300, 3400, 3500, 3600, 3700, 3800, 3900,
+                    4000, 4100, 4200, 4300, 4400, 4500, 4600, 4700, 4800, 4900, 5000, 5100, 5200, 5300, 5400,
+                    5500),
+    }
+    STANDARD["WOA18"] = STANDARD["WOA13v2"]
+
+    __registry = {}
+    __lock = threading.Lock()
+
+    def __init__(self, depths, name=None):
+        depths = np.array(depths, dtype=np.float64).ravel()
+        if len(depths) == 0 or not np.isfinite(depths).all():
+            raise ValueError("Depth levels " + str(name or list(depths)) + " have to be a list of numbers.")
+        if (np.diff(depths) <= 0).any():
+            raise ValueError("Depth levels " + str(name or list(depths)) + " have to be given in increasing "
+                             "order, each once.")
+        depths.setflags(write=False)
+        self.depths = depths
+        self.name = name
+
+    @classmethod
+    def get(cls, depth):
+        if isinstance(depth, DepthLevels):
+            return depth
+        if not isinstance(depth, str):
+            # unicode from arcpy under Python 2, bytes under Python 3
+            depth = depth.encode("ascii", "ignore")
+            if not isinstance(depth, str):
+                depth = depth.decode("ascii")
+        depth = depth.strip()
+
+        with cls.__lock:
+            levels = cls.__registry.get(depth)
+            if levels is None:
+                if depth in cls.STANDARD:
+                    levels = cls(cls.STANDARD[depth], depth)
+                else:
+                    levels = cls([float(item) for item in depth.split(",") if item.strip()], depth)
+                cls.__registry[depth] = levels
+            return levels
+
+    def __len__(self):
+        return len(self.depths)
+
+    def __iter__(self):
+        return iter(self.depths)
+
+    def __getitem__(self, index):
+        return self.depths[index]
+
+    @classmethod
+    def load(cls, path):
+        '''
+         Levels saved with save(), kept next to outputs indexed by level such as bathindex.
+        '''
+        with open(path, "r") as levels_file:
+            saved = json.load(levels_file)
+        return cls(saved["levels"], saved.get("name"))
+
+    def save(self, path):
+        with open(path, "w") as levels_file:
+            json.dump({"name": self.name, "levels": self.depths.tolist()}, levels_file, indent=1)
+        return path
 
-    depth_list = []
-
-    if depth == 'WOA05':
-        depth_list = ["0", "10", "20", "30", "50", "75", "100", "125", "150", "200", "250", "300",
-                      "400", "500", "600","700", "800", "900", "1000", "1100", "1200", "1300", "1400",
-                      "1500", "1750", "2000", "2500", "3000", "3500", "4000", "4500", "5000", "5500"]
-
-    elif depth == 'Steinacher':
-        depth_list = ["6", "19", "38", "62", "93", "133", "183", "245", "322", "415", "527", "661",
-                      "818", "1001", "1211", "1449", "1717", "2014", "2340", "2693", "3072", "3473",
-                      "3894", "4329", "4775"]
-
-    elif depth == 'WOA13v2':
-        depth_list = ["0", "5", "10", "15", "20", "25", "30", "35", "40", "45", "50", "55", "60",
-                      "65", "70", "75", "80", "85", "90", "95", "100", "125", "150", "175", "200",
-                      "225", "250", "275", "300", "325", "350", "375", "400", "425", "450", "475",
-                      "500", "550", "600", "650", "700", "750", "800", "850", "900", "950", "1000",
-                      "1050", "1100", "1150", "1200", "1250", "1300", "1350", "1400", "1450", "1500",
-                      "1550", "1600", "1650", "1700", "1750", "1800", "1850", "1900", "1950", "2000",
-                      "2100", "2200", "2300", "2400", "2500", "2600", "2700", "2800", "2900", "3000",
-                      "3100", "3200", "3300", "3400", "3500", "3600", "3700", "3800", "3900", "4000",
-                      "4100", "4200", "4300", "4400", "4500", "4600", "4700", "4800", "4900", "5000",
-                      "5100", "5200", "5300", "5400", "5500"]
-
-    elif depth == 'WOA18':
-        depth_list = ["0", "5", "10", "15", "20", "25", "30", "35", "40", "45", "50", "55", "60",
-                      "65", "70", "75", "80", "85", "90", "95", "100", "125", "150", "175", "200",
-                      "225", "250", "275", "300", "325", "350", "375", "400", "425", "450", "475",
-                      "500", "550", "600", "650", "700", "750", "800", "850", "900", "950", "1000",
-                      "1050", "1100", "1150", "1200", "1250", "1300", "1350", "1400", "1450", "1500",
-                      "1550", "1600", "1650", "1700", "1750", "1800", "1850", "1900", "1950", "2000",
-                      "2100", "2200", "2300", "2400", "2500", "2600", "2700", "2800", "2900", "3000",
-                      "3100", "3200", "3300", "3400", "3500", "3600", "3700", "3800", "3900", "4000",
-                      "4100", "4200", "4300", "4400", "4500", "4600", "4700", "4800", "4900", "5000",
-                      "5100", "5200", "5300", "5400", "5500"]
-    elif depth != ' ':
-        b = depth.encode('ascii', 'ignore')
-        depth_list = b.split(',')
-
-    return depth_list
+    @staticmethod
+    def label(depth):
+        '''
+         Depth as used in layer names, "bath" + label(depth) or "t_an" + label(depth).
+        '''
+        return str(int(float(depth)))
+
+    def labels(self):
+        return [format(depth, "g") for depth in self.depths]
+
+    def index(self, depth):
+        '''
+         Index of the level depth is on, ValueError if it is not one of the levels.
+        '''
+        index = int(self.nearest(depth))
+        if abs(self.depths[index] - float(depth)) > 0.5:
+            raise ValueError("Depth " + str(depth) + " is not one of the levels of " + str(self.name))
+        return index
+
+    def nearest(self, depths):
+        '''
+         Index of the level nearest each depth.
+        '''
+        depths = np.asarray(depths, dtype=np.float64)
+        upper = np.clip(np.searchsorted(self.depths, depths), 1, max(len(self.depths) - 1, 1))
+        lower = upper - 1
+        if len(self.depths) == 1:
+            return np.zeros(depths.shape, dtype=np.intp)
+        return np.where(np.abs(depths - self.depths[lower]) <= np.abs(self.depths[upper] - depths), lower, upper)
+
+    def floor(self, depths):
+        '''
+         Index of the deepest level at or above each depth (-1 above the first level), the last
+         layer a seabed at that depth still reaches.
+        '''
+        return np.searchsorted(self.depths, np.asarray(depths, dtype=np.float64), "right") - 1
+
+    def bracket(self, depths):
+        '''
+         Indices (lower, upper) of the levels either side of each depth.  Depths above the first
+         or below the last level get that level twice.
+        '''
+        position = np.searchsorted(self.depths, np.asarray(depths, dtype=np.float64), "right")
+        return np.clip(position - 1, 0, len(self.depths) - 1), np.clip(position, 0, len(self.depths) - 1)
+
+    def weights(self, depths):
+        '''
+         (lower, upper, weight) to interpolate linearly between levels, value = (1 - weight) *
+         layer[lower] + weight * layer[upper].  Depths beyond the levels take the nearest level and
+         NaN depths get -1 indices.
+        '''
+        depths = np.asarray(depths, dtype=np.float64)
+        lower, upper = self.bracket(depths)
+        spacing = self.depths[upper] - self.depths[lower]
+        with np.errstate(invalid="ignore"):
+            weight = np.where(spacing > 0, (depths - self.depths[lower]) / np.where(spacing > 0, spacing, 1.0), 0.0)
+        missing = np.isnan(depths)
+        return np.where(missing, -1, lower), np.where(missing, -1, upper), np.where(missing, 0.0, weight)
+
+
+def depth_level_index(bathymetry, levels, no_data_value=349000000.0):
+    '''
+     Index of the deepest level of levels (a DepthLevels) each bathymetry cell reaches, elevations
+     being negative below sea level, as int16 with -1 for NoData cells and cells above the first
+     level.  A cell holds layer k of a depth-stacked variable exactly when its index is k or more.
+    '''
+    bathymetry = np.asarray(bathymetry, dtype=np.float64)
+    valid = (bathymetry != no_data_value) & np.isfinite(bathymetry)
+    index = levels.floor(np.where(valid, -bathymetry, -np.inf))
+    return index.astype(np.int16)
+
+
+def composite_levels(stack, level_index):
+    '''
+     Value of every cell of a (level, row, col) stack at its level_index (see depth_level_index),
+     in one pass over the stack.  Where the layer at that level has no data (NaN) the deepest
+     shallower layer with data is used, as mosaicking the masked layers shallowest first did.
+     Cells with no level or no data at any level up to theirs are NaN.
+    '''
+    levels = np.arange(stack.shape[0]).reshape(-1, 1, 1)
+    valid = np.isfinite(stack) & (levels <= level_index[np.newaxis])
+    values = take_levels(stack, stack.shape[0] - 1 - np.argmax(valid[::-1], axis=0))
+    return np.where(valid.any(axis=0), values, np.nan)
+
+
+def interpolate_levels(stack, lower, upper, weight):
+    '''
+     Linear interpolation of every cell of a (level, row, col) stack between its layers lower and
+     upper, (1 - weight) * stack[lower] + weight * stack[upper], with lower, upper and weight as
+     DepthLevels.weights gives them for the cell depths.  Where one of the two layers has no data
+     the other is used.  Cells with a lower of -1, or no data in either layer, are NaN.
+    '''
+    lower_values = take_levels(stack, np.maximum(lower, 0))
+    upper_values = take_levels(stack, np.maximum(upper, 0))
+    values = (1.0 - weight) * lower_values + weight * upper_values
+    values = np.where(np.isnan(upper_values), lower_values, np.where(np.isnan(lower_values), upper_values, values))
+    return np.where(lower >= 0, values, np.nan)
+
+
+def take_levels(stack, index):
+    '''
+     (row, col) values of a (level, row, col) stack at the level index of every cell.
+    '''
+    if hasattr(np, "take_along_axis"):
+        return np.take_along_axis(stack, index[np.newaxis], axis=0)[0]
+    rows, cols = np.ogrid[:stack.shape[1], :stack.shape[2]]
+    return stack[index, rows, cols]
 
 
 # From Josh Werts - http://joshwerts.com/blog/2014/04/01/arcpy-rename-fields/
@@ -106,6 +278,15 @@ def rename_fields(table, out_table, new_name_by_old_name):
     return out_table
 
 
+def split_multivalue(value):
+    '''
+     Values of a multiValue parameter from its valueAsText, "a;'b c';d", without the quotes.
+    '''
+    if value is None:
+        return []
+    return [item.strip().strip("'\"") for item in value.split(";") if item.strip()]
+
+
 def error_logging(output_directory, log_message):
     import os
     import arcpy
@@ -146,6 +327,99 @@ def downloadremoteurl(URL, OutFile):
     return status_code
 
 
+def open_netcdf(path):
+    '''
+     Opens a NetCDF file with the netCDF4 library, or with h5py for NetCDF4/HDF5 files when netCDF4
+     is not installed.  Returns (dataset, library name).  Values are read raw with either library,
+     fill values and scale_factor/add_offset are left to the caller.
+    '''
+    try:
+        import netCDF4
+        dataset = netCDF4.Dataset(path, "r")
+        dataset.set_auto_maskandscale(False)
+        return dataset, "netCDF4"
+    except ImportError:
+        import h5py
+        return h5py.File(path, "r"), "h5py"
+
+
+def read_netcdf_coordinate(path, name):
+    '''
+     Reads a whole coordinate variable from a NetCDF file in one call.
+    '''
+    dataset, library = open_netcdf(path)
+    try:
+        if library == "h5py":
+            return np.asarray(dataset[name][...], dtype=np.float64)
+        return np.asarray(dataset.variables[name][:], dtype=np.float64)
+    finally:
+        dataset.close()
+
+
+def longitude_roll(lon):
+    '''
+     For longitudes running 0 to 360 returns the number of columns to np.roll the data by, and the
+     rolled longitudes, so that they run -180 to 180 instead.  Returns (0, lon) for anything else.
+    '''
+    lon = np.asarray(lon, dtype=np.float64)
+    if len(lon) == 0 or not (lon.min() >= 0 and lon.max() > 180):
+        return 0, lon
+    shift = int(np.count_nonzero(lon >= 180))
+    rolled = np.roll(lon, shift)
+    rolled[rolled >= 180] -= 360
+    return shift, rolled
+
+
+class NetCDFMetadataCache(object):
+    '''
+     Process wide, least recently used cache of what NetCDFFile works out about a file (dimensions,
+     variables, lat/lon dimension names, coordinate values, whether longitudes run 0 to 360).
+     Entries are keyed by path, size and modification time, so a file that changes on disk is read
+     again.  updateParameters builds a NetCDFFile on every change in the tool dialog, with the cache
+     only the first one has to open the file.
+    '''
+
+    def __init__(self, max_entries=16):
+        self.max_entries = max_entries
+        self.__entries = OrderedDict()
+        self.__lock = threading.Lock()
+
+    @staticmethod
+    def key(path):
+        status = os.stat(path)
+        return os.path.normcase(os.path.abspath(path)), status.st_size, status.st_mtime
+
+    def get(self, path):
+        try:
+            key = self.key(path)
+        except OSError:
+            return None
+        with self.__lock:
+            metadata = self.__entries.pop(key, None)
+            if metadata is not None:
+                self.__entries[key] = metadata
+            return metadata
+
+    def put(self, path, metadata):
+        try:
+            key = self.key(path)
+        except OSError:
+            return metadata
+        with self.__lock:
+            self.__entries.pop(key, None)
+            self.__entries[key] = metadata
+            while len(self.__entries) > self.max_entries:
+                self.__entries.popitem(last=False)
+        return metadata
+
+    def clear(self):
+        with self.__lock:
+            self.__entries.clear()
+
+
+netcdf_metadata_cache = NetCDFMetadataCache()
+
+
 class NetCDFFile(object):
     """-------------------------------------------------------------------------------------
     Class Name: NetCDFFile
@@ -169,14 +443,28 @@ class NetCDFFile(object):
 
     def __init__(self, netCDFloc):
         '''
-         Defines the Class Properties based off the the NetCDF File Properties inputted
+         Defines the Class Properties based off the the NetCDF File Properties inputted,
+         or from netcdf_metadata_cache if this file has been looked at before
         '''
-        ncFileProp = arcpy.NetCDFFileProperties(netCDFloc)
-        self.__ncFileProperties = ncFileProp
-
         self.__sourceLocation = netCDFloc;
-        self.__determineDimensions()
-        self.__determineVariables()
+        self.__metadata = netcdf_metadata_cache.get(netCDFloc)
+
+        if self.__metadata is None:
+            ncFileProp = arcpy.NetCDFFileProperties(netCDFloc)
+            self.__ncFileProperties = ncFileProp
+
+            self.__determineDimensions()
+            self.__determineVariables()
+            self.__metadata = netcdf_metadata_cache.put(netCDFloc, {"dimensions": self.__dimensions,
+                                                                    "variables": self.__variables,
+                                                                    "latDimension": self.__latDimension,
+                                                                    "lonDimension": self.__lonDimension,
+                                                                    "coordinates": {}})
+        else:
+            self.__dimensions = self.__metadata["dimensions"]
+            self.__variables = self.__metadata["variables"]
+            self.__latDimension = self.__metadata["latDimension"]
+            self.__lonDimension = self.__metadata["lonDimension"]
 
     def __determineDimensions(self):
         '''
@@ -221,44 +509,49 @@ class NetCDFFile(object):
 
         return variables
 
+    def getCoordinateValues(self, dimension):
+        '''
+        Reads a whole coordinate variable in one call, natively if netCDF4 or h5py are
+        installed, otherwise through a netCDF table view.  Kept in the metadata cache.
+        '''
+        coordinates = self.__metadata["coordinates"]
+        if dimension not in coordinates:
+            try:
+                values = read_netcdf_coordinate(self.__sourceLocation, dimension)
+            except (ImportError, IOError, KeyError, RuntimeError):
+                arcpy.MakeNetCDFTableView_md(self.__sourceLocation, dimension, "coordinate_values", dimension)
+                values = np.asarray(arcpy.da.TableToNumPyArray("coordinate_values", dimension)[dimension],
+                                    dtype=np.float64)
+                arcpy.Delete_management("coordinate_values")
+            # Shared by every NetCDFFile of this file, so nobody gets to change it
+            values.flags.writeable = False
+            coordinates[dimension] = values
+        return coordinates[dimension]
+
     def __is0to360(self):
         '''
         We need to check to get the Min and Max lon values to determine if
         the dataset goes from 0 - 360 or -180 - 180
         '''
+        if "is0to360" not in self.__metadata:
+            lonValues = self.getCoordinateValues(self.__lonDimension)
+            minLon = lonValues.min()
+            maxLon = lonValues.max()
 
-        is0to360 = False
-
-        netCDFProp = self.__ncFileProperties;
-        dimLen = netCDFProp.getDimensionSize(self.__lonDimension);
-
-        # Determining the min and max dim.  Looking for values less than 0 and/or greater
-        # than 180
-        minLon = 360
-        maxLon = -180
-        start = time.time()
-
-        for index in range(0, dimLen):
-
-            value = netCDFProp.getDimensionValue(self.__lonDimension, index)
-            elapsed = (time.time() - start)
-            arcpy.AddMessage("Get Dimension Value for index: " + str(index) + "...." + str(elapsed))
-
-            if value < minLon:
-                minLon = value;
-            if value > maxLon:
-                maxLon = value;
-
-        arcpy.AddMessage("Min Lon Value: " + str(minLon))
-        arcpy.AddMessage("Max Lon Value: " + str(maxLon))
+            # Checking if the min and or max values fall in the right range
+            self.__metadata["is0to360"] = bool(minLon >= 0 and maxLon > 180)
 
-        # Checking if the min and or max values fall in the right range
-        if minLon >= 0 and maxLon > 180:
-            is0to360 = True
+            arcpy.AddMessage("Lon values run from " + str(minLon) + " to " + str(maxLon) +
+                             ", is 0 to 360: " + str(self.__metadata["is0to360"]))
 
-        arcpy.AddMessage("Is 0 to 360" + str(is0to360))
+        return self.__metadata["is0to360"]
 
-        return is0to360
+    def getLonRoll(self):
+        '''
+        Number of columns to np.roll data read from this file by so its longitudes run -180 to 180
+        (0 when they already do), and the rolled longitude values.
+        '''
+        return longitude_roll(self.getCoordinateValues(self.__lonDimension))
 
     def getDimensions(self):
         return self.__dimensions
@@ -281,14 +574,16 @@ class NetCDFFile(object):
     def makeNetCDFTable(self, inpnt, variableName, rowDim, outTableView):
         '''
          Method Name:  makeNetCDFTable
-         Description:  Creates a netCDF Table view from the first point selected
-                       on the map, the variable choosen and the row dimension.  The
-                       table contains every variable value at that particular point
-                       for each slice of the row dimension.  For example: Every sea
-                       temperature (Variable) value at each elevation(Row Dimension)
-                       for a particular point(Input Point) in sea.
+         Description:  Creates a table view of vertical profiles at every point in the
+                       input features, for the variable choosen and the row dimension.
+                       The table has a row for each point and slice of the row
+                       dimension.  For example: Every sea temperature (Variable) value
+                       at each elevation(Row Dimension) for each point(Input Point) in
+                       sea.  All points are read from the file in one go (see
+                       NetCDFSlabReader.read_profiles), without netCDF4 or h5py (or a
+                       NetCDF3 file with only h5py) only the first point is used.
          Input:
-                       inpnt:         The selected Point
+                       inpnt:         The selected Points
                        variableName:  The variable to get each value
                        rowDim:        How to slice up the netCDF file
                        outTableView:  The table being outputed
@@ -306,36 +601,41 @@ class NetCDFFile(object):
         arcpy.AddMessage("Lat Dim: " + latVar)
         arcpy.AddMessage("Lon Dim: " + lonVar)
 
-        copyStartTime = time.time()
-
-        arcpy.CopyFeatures_management(inpnt, r'in_memory\updateFeat')
-
-        elapsedTime = (time.time() - copyStartTime)
-        arcpy.AddMessage("Copy Features " + str(elapsedTime))
-
-        is0to360 = self.__is0to360()
-
-        # Only getting the first point.  Others ignored
-        with arcpy.da.SearchCursor('in_memory\updateFeat', ('SHAPE@X', 'SHAPE@Y')) as cursor:
-            for row in cursor:
-
-                # Store x,y coordinates of current point
-                if is0to360:
-                    self.__lonValue = row[0] + 180
-                else:
-                    self.__lonValue = row[0]
-
-                self.__latValue = row[1]
-
-                arcpy.AddMessage(lonVar + ": " + str(self.__lonValue) + " " + latVar + ": " + str(self.__latValue))
-
-        netCDFStartTime = time.time()
-        arcpy.MakeNetCDFTableView_md(netCDFSource, variableName, outTableView, rowDim,
-                                     lonVar + " " + str(self.__lonValue) + ";" + latVar + " " + str(self.__latValue),
-                                     "BY_VALUE")
-
-        elapsedNetCDFTime = (time.time() - copyStartTime)
-        arcpy.AddMessage("Make netCDF Table Time: " + str(elapsedNetCDFTime))
+        startTime = time.time()
+
+        points = arcpy.da.FeatureClassToNumPyArray(inpnt, ('OID@', 'SHAPE@X', 'SHAPE@Y'))
+        arcpy.AddMessage("Read " + str(len(points)) + " points " + str(time.time() - startTime))
+        if len(points) == 0:
+            raise ValueError("There are no points in " + str(inpnt) + " to make a NetCDF table for")
+
+        self.__lonValue = points['SHAPE@X'][0]
+        self.__latValue = points['SHAPE@Y'][0]
+
+        try:
+            reader = NetCDFSlabReader(netCDFSource, variableName, None, latVar, lonVar, rowDim)
+        except (ImportError, IOError, OSError):
+            # Neither library is installed, or h5py can not open the file (a NetCDF3 file when only
+            # h5py is installed), so arcpy makes the table from the first point.  Store its x,y
+            # coordinates, in the 0 - 360 range if the file uses it
+            if self.__is0to360():
+                self.__lonValue = self.__lonValue % 360
+            arcpy.AddMessage(lonVar + ": " + str(self.__lonValue) + " " + latVar + ": " + str(self.__latValue))
+            arcpy.MakeNetCDFTableView_md(netCDFSource, variableName, outTableView, rowDim,
+                                         lonVar + " " + str(self.__lonValue) + ";" + latVar + " " +
+                                         str(self.__latValue), "BY_VALUE")
+            arcpy.AddMessage("Make netCDF Table Time: " + str(time.time() - startTime))
+            return
+
+        with reader:
+            profiles = reader.read_profiles(points['SHAPE@X'], points['SHAPE@Y'], point_ids=points['OID@'])
+
+        profileTable = r'in_memory\netCDFProfiles'
+        if arcpy.Exists(profileTable):
+            arcpy.Delete_management(profileTable)
+        arcpy.da.NumPyArrayToTable(profiles, profileTable)
+        arcpy.MakeTableView_management(profileTable, outTableView)
+
+        arcpy.AddMessage("Make netCDF Table Time: " + str(time.time() - startTime))
 
     @staticmethod
     def isNetCDF(netCDFLoc):
@@ -368,54 +668,1835 @@ class NetCDFFile(object):
         return datasource.replace('\\' + netCDFLayer.datasetName, '')
 
 
-def raster_to_xyz(raster, raster_name, output, no_data_value):
-    raster_desc = arcpy.Describe(raster)
-    raster_x_min = raster_desc.Extent.XMin
-    raster_y_min = raster_desc.Extent.YMin
-    raster_ch = raster_desc.MeanCellHeight
-    raster_cw = raster_desc.MeanCellWidth
-    raster_h = raster_desc.Height
-    raster_w = raster_desc.Width
-
-    # Adjust start of xmin and ymin to adjust for centroids
-    raster_x_min_adj = raster_x_min + (0.5 * raster_cw)
-    raster_y_min_adj = raster_y_min + (0.5 * raster_ch)
-
-    ## Build coordinates
-    def raster_centroid_x(raster_h, raster_w):
-        coordinates_x = raster_x_min_adj + (raster_cw * raster_w)
-        return coordinates_x
-    raster_coordinates_x = np.fromfunction(raster_centroid_x, (raster_h, raster_w))  # numpy array of X coord
-
-    def raster_centroid_y(raster_h, raster_w):
-        coordinates_y = raster_y_min_adj + (raster_ch * raster_h)
-        return coordinates_y
-    raster_coordinates_y = np.fromfunction(raster_centroid_y, (raster_h, raster_w))  # numpy array of Y coord
-
-    coordinates_y = raster_y_min_adj + (raster_ch * raster_h)
-    coordinates_x = raster_x_min_adj + (raster_cw * raster_w)
-
-    # combine arrays of coordinates (although array for Y is before X, dstack produces [X, Y] pairs)
-    raster_coordinates = np.dstack((raster_coordinates_y, raster_coordinates_x))
-    del raster_coordinates_y, raster_coordinates_x
-    gc.collect()
+def parse_extent(extent):
+    '''
+     Turns a GPExtent string ("XMin YMin XMax YMax", optionally followed by a spatial reference), an
+     arcpy Extent or a sequence into a (x_min, y_min, x_max, y_max) tuple of floats.
+    '''
+    if extent is None:
+        return None
+    if hasattr(extent, "XMin"):
+        return float(extent.XMin), float(extent.YMin), float(extent.XMax), float(extent.YMax)
+    if isinstance(extent, (tuple, list)):
+        return tuple(float(value) for value in extent[0:4])
+    values = str(extent).replace(",", " ").split()
+    if not values:
+        return None
+    return tuple(float(value) for value in values[0:4])
+
+
+def nearest_cell(coordinate, values):
+    '''
+     Index of the nearest value in an ascending coordinate array for each of values, or -1 where a
+     value lies more than half a cell beyond either end.
+    '''
+    coordinate = np.asarray(coordinate, dtype=np.float64)
+    values = np.asarray(values, dtype=np.float64)
+    if len(coordinate) == 1:
+        return np.zeros(values.shape, dtype=int)
+    index = np.searchsorted(0.5 * (coordinate[1:] + coordinate[:-1]), values)
+    half_cell = 0.5 * (coordinate[-1] - coordinate[0]) / (len(coordinate) - 1)
+    outside = (values < coordinate[0] - half_cell) | (values > coordinate[-1] + half_cell) | np.isnan(values)
+    index[outside] = -1
+    return index
+
+
+class NetCDFSlabReader(object):
+    '''
+     Reads a variable from a NetCDF file as depth x lat x lon arrays using the netCDF4 library (or
+     h5py for NetCDF4/HDF5 files), without arcpy.  The file is opened once and the lat and lon
+     coordinates are read in bulk and cropped to extent, so each read only touches the cells needed.
+     Rows of the returned arrays run south to north (the GridDescriptor order) and fill values come
+     back as NaN.  Files with longitudes from 0 to 360 are rolled to run -180 to 180.  Any other
+     dimension (the time of a monthly or seasonal climatology) is read at time_index, or at the
+     time_index given to read, so time steps can be streamed one at a time.
+    '''
+
+    def __init__(self, path, variable, extent=None, lat_name="lat", lon_name="lon", depth_name="depth",
+                 time_index=0):
+        self.path = path
+        self.variable = variable
+        self.lat_name = lat_name
+        self.lon_name = lon_name
+        self.depth_name = depth_name
+        self.time_index = time_index
+
+        self.__dataset, self.__library = open_netcdf(path)
+        self.__variable = self.__dataset[variable] if self.__library == "h5py" else self.__dataset.variables[variable]
+        self.dimensions = self.__dimension_names()
+
+        # Steps along the time (or any other extra) dimension, 0 if the variable has none
+        self.time_count = 0
+        for axis, dimension in enumerate(self.dimensions):
+            if dimension not in (lat_name, lon_name, depth_name):
+                self.time_count = int(self.__variable.shape[axis])
+
+        lat = self.__coordinate(lat_name)
+        lon = self.__coordinate(lon_name)
+        self.depths = self.__coordinate(depth_name) if depth_name in self.dimensions else np.zeros(1)
+
+        # Rows are put south to north and the columns of a 0 - 360 file in rolled order, which may
+        # wrap around the file, so keep the file index of every row and column handed back
+        lat_order = np.arange(len(lat))
+        if len(lat) > 1 and lat[0] > lat[-1]:
+            lat = lat[::-1]
+            lat_order = lat_order[::-1]
+        shift, lon = longitude_roll(lon)
+        lon_order = np.roll(np.arange(len(lon)), shift)
+
+        lat_slice = self.__crop(lat, extent, 1)
+        lon_slice = self.__crop(lon, extent, 0)
+        self.lat = lat[lat_slice]
+        self.lon = lon[lon_slice]
+        self.__lat_index = lat_order[lat_slice]
+        self.__lon_index = lon_order[lon_slice]
+
+    def __dimension_names(self):
+        if self.__library == "h5py":
+            return [str(dimension[0].name).lstrip("/") if len(dimension) else dimension.label
+                    for dimension in self.__variable.dims]
+        return [str(dimension) for dimension in self.__variable.dimensions]
+
+    def __coordinate(self, name):
+        if self.__library == "h5py":
+            return np.asarray(self.__dataset[name][...], dtype=np.float64)
+        return np.asarray(self.__dataset.variables[name][:], dtype=np.float64)
+
+    @staticmethod
+    def __crop(coordinate, extent, axis):
+        extent = parse_extent(extent)
+        if extent is None:
+            return slice(0, len(coordinate))
+        inside = np.flatnonzero((coordinate >= extent[axis]) & (coordinate <= extent[axis + 2]))
+        if len(inside) == 0:
+            raise ValueError("The extraction extent does not overlap the NetCDF file")
+        return slice(int(inside[0]), int(inside[-1]) + 1)
+
+    def __attribute(self, name):
+        if self.__library == "h5py":
+            value = self.__variable.attrs.get(name)
+        else:
+            value = getattr(self.__variable, name, None)
+        return None if value is None else np.ravel(value)[0]
+
+    @property
+    def grid(self):
+        '''
+         GridDescriptor of the cropped NetCDF cells.
+        '''
+        cell_width = (self.lon[-1] - self.lon[0]) / (len(self.lon) - 1) if len(self.lon) > 1 else 1.0
+        cell_height = (self.lat[-1] - self.lat[0]) / (len(self.lat) - 1) if len(self.lat) > 1 else 1.0
+        return GridDescriptor(self.lon[0] - 0.5 * cell_width, self.lat[0] - 0.5 * cell_height,
+                              cell_width, cell_height, len(self.lat), len(self.lon))
+
+    def depth_index(self, depth):
+        index = int(np.argmin(np.abs(self.depths - float(depth))))
+        if abs(self.depths[index] - float(depth)) > 0.5:
+            raise ValueError("Depth " + str(depth) + " is not in " + str(self.path))
+        return index
+
+    def read(self, depths=None, window=None, time_index=None):
+        '''
+         Reads the hyperslab for the requested depths (all depths if None) in one contiguous read
+         covering the shallowest to the deepest of them.  window (row_start, row_stop, col_start,
+         col_stop) narrows the read to part of the cropped grid.  Returns a float32 array (depth,
+         lat, lon).
+        '''
+        time_index = self.time_index if time_index is None else time_index
+        if depths is None:
+            index = np.arange(len(self.depths))
+        else:
+            index = np.array([self.depth_index(depth) for depth in depths], dtype=int)
+
+        (row_start, row_stop, col_start, col_stop) = window or (0, len(self.lat), 0, len(self.lon))
+        lat_index = self.__lat_index[row_start:row_stop]
+        lon_index = self.__lon_index[col_start:col_stop]
+
+        selection = []
+        for dimension in self.dimensions:
+            if dimension == self.lat_name:
+                selection.append(slice(int(lat_index.min()), int(lat_index.max()) + 1))
+            elif dimension == self.lon_name:
+                selection.append(slice(int(lon_index.min()), int(lon_index.max()) + 1))
+            elif dimension == self.depth_name:
+                selection.append(slice(int(index.min()), int(index.max()) + 1))
+            else:
+                selection.append(time_index)
+
+        values = np.asarray(self.__variable[tuple(selection)], dtype=np.float32)
+
+        # Put the axes in depth, lat, lon order
+        axes = [dimension for dimension in self.dimensions if dimension in (self.depth_name, self.lat_name,
+                                                                            self.lon_name)]
+        if self.depth_name not in axes:
+            values = values[np.newaxis]
+            axes.insert(0, self.depth_name)
+        values = np.transpose(values, [axes.index(self.depth_name), axes.index(self.lat_name),
+                                       axes.index(self.lon_name)])
+
+        # Pick the requested depths, rows and columns out of the block read, in order
+        for axis, take in enumerate([index - index.min(), lat_index - lat_index.min(), lon_index - lon_index.min()]):
+            if not np.array_equal(take, np.arange(values.shape[axis])):
+                values = np.take(values, take, axis=axis)
+
+        scale_factor = self.__attribute("scale_factor")
+        add_offset = self.__attribute("add_offset")
+        for no_data_attribute in ["_FillValue", "missing_value"]:
+            no_data_value = self.__attribute(no_data_attribute)
+            if no_data_value is not None:
+                values[values == np.float32(no_data_value)] = np.nan
+        if scale_factor is not None:
+            values *= np.float32(scale_factor)
+        if add_offset is not None:
+            values += np.float32(add_offset)
+
+        return np.ascontiguousarray(values)
+
+    def read_profiles(self, x, y, depths=None, point_ids=None):
+        '''
+         Vertical profiles at many points.  Points are matched to their nearest grid cell in one
+         vectorized step, the window holding all of them is read once and the depth x points matrix
+         is gathered with fancy indexing.  Returns a columnar table (numpy structured array, one row
+         per point and depth) with POINT_ID, X, Y, the depth and the variable.  Points more than half
+         a cell outside the grid get NaN.
+        '''
+        x = np.asarray(x, dtype=np.float64)
+        y = np.asarray(y, dtype=np.float64)
+        if point_ids is None:
+            point_ids = np.arange(len(x))
+
+        # Longitudes may come in as 0 - 360 or -180 - 180, the reader works in the latter
+        x_wrapped = np.where(x > 180, x - 360, x)
+        rows = nearest_cell(self.lat, y)
+        cols = nearest_cell(self.lon, x_wrapped)
+        inside = (rows >= 0) & (cols >= 0)
+
+        depth_values = self.depths if depths is None else self.depths[[self.depth_index(depth) for depth in depths]]
+        profiles = np.full((len(depth_values), len(x)), np.nan, dtype=np.float32)
+        if inside.any():
+            window = (int(rows[inside].min()), int(rows[inside].max()) + 1,
+                      int(cols[inside].min()), int(cols[inside].max()) + 1)
+            slab = self.read(depths, window)
+            profiles[:, inside] = slab[:, rows[inside] - window[0], cols[inside] - window[2]]
+
+        table = np.zeros(len(x) * len(depth_values), dtype=[("POINT_ID", np.int32), ("X", np.float64),
+                                                             ("Y", np.float64), (str(self.depth_name), np.float64),
+                                                             (str(self.variable), np.float32)])
+        table["POINT_ID"] = np.repeat(point_ids, len(depth_values))
+        table["X"] = np.repeat(x, len(depth_values))
+        table["Y"] = np.repeat(y, len(depth_values))
+        table[str(self.depth_name)] = np.tile(depth_values, len(x))
+        table[str(self.variable)] = profiles.T.ravel()
+        return table
+
+    def read_depth(self, depth, time_index=None):
+        return self.read([depth], time_index=time_index)[0]
+
+    def valid_counts(self, depths=None, sample_cells=16384):
+        '''
+         Estimated number of cells with data at each depth, for ordering work by size.  Cells are
+         counted on a regular subsample of about sample_cells cells per depth, taken for every
+         depth in one strided read, and scaled up to the cropped grid.  Depths missing from the
+         file count as 0.
+        '''
+        depths = self.depths if depths is None else depths
+        counts = np.zeros(len(depths), dtype=np.int64)
+        found = []
+        for number, depth in enumerate(depths):
+            try:
+                found.append((number, self.depth_index(depth)))
+            except ValueError:
+                pass
+        if not found:
+            return counts
+
+        index = np.array([depth_index for number, depth_index in found])
+        step = max(1, int(np.sqrt(len(self.lat) * len(self.lon) / float(sample_cells))))
+        selection = []
+        for dimension in self.dimensions:
+            if dimension == self.lat_name:
+                selection.append(slice(int(self.__lat_index.min()), int(self.__lat_index.max()) + 1, step))
+            elif dimension == self.lon_name:
+                selection.append(slice(int(self.__lon_index.min()), int(self.__lon_index.max()) + 1, step))
+            elif dimension == self.depth_name:
+                selection.append(slice(int(index.min()), int(index.max()) + 1))
+            else:
+                selection.append(self.time_index)
+        values = np.asarray(self.__variable[tuple(selection)])
+
+        valid = np.isfinite(values)
+        for no_data_attribute in ["_FillValue", "missing_value"]:
+            no_data_value = self.__attribute(no_data_attribute)
+            if no_data_value is not None:
+                valid &= values != no_data_value
+        axes = [dimension for dimension in self.dimensions if dimension in (self.depth_name, self.lat_name,
+                                                                            self.lon_name)]
+        if self.depth_name in axes:
+            valid = np.rollaxis(valid, axes.index(self.depth_name), 0)
+        valid = valid.reshape(int(index.max() - index.min()) + 1, -1)
+
+        scale = len(self.lat) * len(self.lon) / float(max(valid.shape[1], 1))
+        for number, depth_index in found:
+            counts[number] = int(round(np.count_nonzero(valid[depth_index - index.min()]) * scale))
+        return counts
+
+    def close(self):
+        self.__dataset.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.close()
+
+
+class GridDescriptor(object):
+    '''
+     Describes a regular grid by its lower left corner, cell size and shape, and works out cell
+     centroids only when they are asked for, so a run can share one small descriptor instead of
+     storing the coordinates of every cell.  Rows are counted from the bottom of the grid, the same
+     order raster_to_xyz writes them in, and flat cell indices are row * cols + col.
+    '''
+
+    def __init__(self, x_min, y_min, cell_width, cell_height, rows, cols):
+        self.x_min = float(x_min)
+        self.y_min = float(y_min)
+        self.cell_width = float(cell_width)
+        self.cell_height = float(cell_height)
+        self.rows = int(rows)
+        self.cols = int(cols)
+
+    @classmethod
+    def from_raster(cls, raster):
+        raster_desc = arcpy.Describe(raster)
+        return cls(raster_desc.Extent.XMin, raster_desc.Extent.YMin, raster_desc.MeanCellWidth,
+                   raster_desc.MeanCellHeight, raster_desc.Height, raster_desc.Width)
+
+    @classmethod
+    def from_extent(cls, extent, cell_size):
+        '''
+         Grid of square cell_size cells covering extent (see parse_extent), rounded to whole cells.
+        '''
+        (x_min, y_min, x_max, y_max) = parse_extent(extent)
+        cell_size = float(cell_size)
+        return cls(x_min, y_min, cell_size, cell_size, max(1, int(round((y_max - y_min) / cell_size))),
+                   max(1, int(round((x_max - x_min) / cell_size))))
 
-    ##Raster conversion to NumPy Array
-    raster_values = arcpy.RasterToNumPyArray(raster)
+    def intersect(self, extent):
+        '''
+         (x_min, y_min, x_max, y_max) overlap of this grid and another extent, the grid extent when
+         extent is None.
+        '''
+        extent = parse_extent(extent)
+        if extent is None:
+            return self.extent
+        (x_min, y_min, x_max, y_max) = extent
+        return (max(x_min, self.extent[0]), max(y_min, self.extent[1]), min(x_max, self.extent[2]),
+                min(y_max, self.extent[3]))
+
+    @classmethod
+    def from_transform(cls, transform):
+        (x_min, cell_width, y_min, cell_height, rows, cols) = transform
+        return cls(x_min, y_min, cell_width, cell_height, rows, cols)
+
+    @classmethod
+    def load(cls, path):
+        '''
+         Reads a descriptor saved with save(), or the transform of a binary XYZ dataset header.
+        '''
+        with open(path, "r") as grid_file:
+            return cls.from_transform(json.load(grid_file)["transform"])
 
-    # flip array upside down - then lower left corner cells has the same index as cells in coordinates array
-    raster_values = np.flipud(raster_values)
+    def save(self, path):
+        with open(path, "w") as grid_file:
+            json.dump({"transform": self.transform}, grid_file, indent=1)
+        return path
+
+    @property
+    def transform(self):
+        return [self.x_min, self.cell_width, self.y_min, self.cell_height, self.rows, self.cols]
 
-    # combine coordinates and value
-    raster_values_full = np.dstack((raster_coordinates, raster_values))
-    out = csv.writer(open(os.path.join(output, str(raster_name) + ".yxz"), "wb"),
-                     delimiter=' ', quoting=csv.QUOTE_NONNUMERIC)
-    (height, width, dim) = raster_values_full.shape
-    for row in range(0, height):
-        for col in range(0, width):
-            out.writerow(raster_values_full[row, col])
+    @property
+    def shape(self):
+        return self.rows, self.cols
+
+    @property
+    def size(self):
+        return self.rows * self.cols
+
+    @property
+    def extent(self):
+        return (self.x_min, self.y_min, self.x_min + self.cols * self.cell_width,
+                self.y_min + self.rows * self.cell_height)
+
+    def centroid(self, row, col):
+        '''
+         Centroid (y, x) of a cell, row and col may be scalars or arrays.
+        '''
+        y = self.y_min + (np.asarray(row) + 0.5) * self.cell_height
+        x = self.x_min + (np.asarray(col) + 0.5) * self.cell_width
+        return y, x
+
+    def coordinates(self, index=None):
+        '''
+         Centroids (y, x) of the flat cell indices given, or of every cell if index is None.
+        '''
+        if index is None:
+            index = np.arange(self.size)
+        rows, cols = np.divmod(np.asarray(index), self.cols)
+        return self.centroid(rows, cols)
+
+    def block(self, row_start, row_stop):
+        '''
+         Centroids (y, x) of every cell in rows row_start to row_stop - 1.
+        '''
+        row_stop = min(row_stop, self.rows)
+        return self.coordinates(np.arange(row_start * self.cols, row_stop * self.cols))
+
+    def iter_blocks(self, block_size=1048576):
+        '''
+         Generator yielding (row_offset, y, x) for strips of whole rows of at most block_size cells.
+        '''
+        block_rows = max(1, int(block_size) // self.cols)
+        for row in range(0, self.rows, block_rows):
+            y, x = self.block(row, row + block_rows)
+            yield row, y, x
+
+    def __eq__(self, other):
+        return isinstance(other, GridDescriptor) and self.transform == other.transform
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def aligned(self, other, tolerance=1e-6):
+        '''
+         Whether other has the same shape and its cells line up with these to within tolerance of a
+         cell, as rasters written on a grid may come back with rounded corners.
+        '''
+        return (self.rows, self.cols) == (other.rows, other.cols) and \
+            all(abs(mine - theirs) <= tolerance * self.cell_width
+                for mine, theirs in [(self.x_min, other.x_min), (self.cell_width, other.cell_width)]) and \
+            all(abs(mine - theirs) <= tolerance * self.cell_height
+                for mine, theirs in [(self.y_min, other.y_min), (self.cell_height, other.cell_height)])
+
+    def __repr__(self):
+        return "GridDescriptor(" + ", ".join(str(value) for value in self.transform) + ")"
+
+
+def array_to_raster(values, grid, output, spatial_reference=None, no_data_value=349000000.0):
+    '''
+     Saves an array on a GridDescriptor grid (bottom row first) as a raster, NaN cells become NoData.
+    '''
+    values = np.flipud(np.where(np.isnan(values), no_data_value, values))
+    output_raster = arcpy.NumPyArrayToRaster(values, arcpy.Point(grid.x_min, grid.y_min),
+                                             grid.cell_width, grid.cell_height, no_data_value)
+    output_raster.save(output)
+    if spatial_reference is not None:
+        arcpy.DefineProjection_management(output, spatial_reference)
+    return output
+
+
+def staging_name(output):
+    '''
+     Name a raster is written under before publish_raster moves it to output.
+    '''
+    (root, extension) = os.path.splitext(output)
+    return root + "_s" + extension
+
+
+def publish_raster(staging, output):
+    '''
+     Moves a finished raster from its staging name to output, so output only ever exists complete.
+    '''
+    if arcpy.Exists(output):
+        arcpy.Delete_management(output)
+    arcpy.Rename_management(staging, output)
+    return output
+
+
+def replace_file(staging, path):
+    '''
+     Moves a file written aside at staging over path in one step, so path is never left half written.
+    '''
+    if hasattr(os, "replace"):
+        os.replace(staging, path)
+    else:
+        # Python 2 has no os.replace, and os.rename does not overwrite on Windows
+        if os.path.exists(path):
+            os.remove(path)
+        os.rename(staging, path)
+
+
+def build_pyramids_and_statistics(raster):
+    arcpy.BuildPyramids_management(raster, "-1", "NONE", "NEAREST", "DEFAULT", "75", "SKIP_EXISTING")
+    arcpy.CalculateStatistics_management(raster, "1", "1", "", "SKIP_EXISTING")
+
+
+PIXEL_TYPES = {"uint8": "8_BIT_UNSIGNED", "int16": "16_BIT_SIGNED", "int32": "32_BIT_SIGNED",
+               "float32": "32_BIT_FLOAT", "float64": "64_BIT"}
+
+
+class RasterBlockWriter(object):
+    '''
+     Writes a raster on a GridDescriptor grid strip by strip, bottom first as raster_blocks reads
+     them, so outputs larger than memory can be built.  Strips are saved as rasters in a temporary
+     folder next to output and mosaicked into it by close(), a grid written as one strip is saved
+     directly.  The raster is built under its staging name and only published once complete.
+    '''
+
+    def __init__(self, output, grid, spatial_reference=None, no_data_value=349000000.0):
+        self.output = output
+        self.grid = grid
+        self.spatial_reference = spatial_reference
+        self.no_data_value = no_data_value
+        self.pixel_type = None
+        self.__staging = staging_name(output)
+        self.__strips = []
+        self.__folder = None
+
+    def write(self, row_offset, values):
+        if values.dtype.kind == "f":
+            values = np.where(np.isnan(values), self.no_data_value, values)
+        self.pixel_type = PIXEL_TYPES[values.dtype.name]
+        strip = arcpy.NumPyArrayToRaster(np.flipud(values),
+                                         arcpy.Point(self.grid.x_min, self.grid.y_min + row_offset * self.grid.cell_height),
+                                         self.grid.cell_width, self.grid.cell_height, self.no_data_value)
+        if row_offset == 0 and values.shape[0] == self.grid.rows:
+            strip.save(self.__staging)
+            return
+        if self.__folder is None:
+            self.__folder = tempfile.mkdtemp(prefix="strips", dir=os.path.dirname(self.output) or None)
+        path = os.path.join(self.__folder, "strip" + str(len(self.__strips)) + ".tif")
+        strip.save(path)
+        self.__strips.append(path)
+
+    def close(self):
+        if self.__strips:
+            arcpy.MosaicToNewRaster_management(self.__strips, os.path.dirname(self.__staging),
+                                               os.path.basename(self.__staging), self.spatial_reference,
+                                               self.pixel_type, self.grid.cell_width, 1)
+            for strip in self.__strips:
+                arcpy.Delete_management(strip)
+            shutil.rmtree(self.__folder, ignore_errors=True)
+            self.__strips = []
+        elif self.spatial_reference is not None:
+            arcpy.DefineProjection_management(self.__staging, self.spatial_reference)
+        return publish_raster(self.__staging, self.output)
+
+    def abort(self):
+        '''
+         Deletes the strips written so far, leaving no raster behind.
+        '''
+        for strip in self.__strips:
+            arcpy.Delete_management(strip)
+        if self.__folder is not None:
+            shutil.rmtree(self.__folder, ignore_errors=True)
+        self.__strips = []
+        if arcpy.Exists(self.__staging):
+            arcpy.Delete_management(self.__staging)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+class ValidPointTrees(object):
+    '''
+     KD-trees over the source points valid in a layer, kept for the last few distinct sets of valid
+     points, so the layers of other variables with the same missing points (the same depth) reuse
+     them.  tree(valid) returns (tree, index of the valid points).
+    '''
+
+    def __init__(self, source, max_trees=8):
+        self.source = source
+        self.max_trees = max_trees
+        self.__trees = OrderedDict()
+
+    def tree(self, valid):
+        from scipy.spatial import cKDTree
+
+        key = hashlib.sha1(np.packbits(valid).tobytes()).hexdigest()
+        entry = self.__trees.pop(key, None)
+        if entry is None:
+            valid_index = np.flatnonzero(valid)
+            entry = (cKDTree(self.source[valid_index]), valid_index)
+        self.__trees[key] = entry
+        while len(self.__trees) > self.max_trees:
+            self.__trees.popitem(last=False)
+        return entry
+
+
+def unique_rows(rows):
+    '''
+     Distinct rows of a 2d array and the index of each row among them, np.unique(rows, axis=0,
+     return_inverse=True) for numpy older than 1.13.
+    '''
+    rows = np.ascontiguousarray(rows)
+    view = rows.view(np.dtype((np.void, rows.dtype.itemsize * rows.shape[1]))).ravel()
+    first, inverse = np.unique(view, return_index=True, return_inverse=True)[1:]
+    return rows[first], inverse.ravel()
+
+
+class IDWInterpolator(object):
+    '''
+     Inverse distance weighted interpolation from a fixed set of source points onto every cell of a
+     GridDescriptor grid, the numpy version of Idw_sa with a "VARIABLE n" search.  The neighbour
+     search (a KD-tree) and the weights are worked out once, in the constructor, and kept as a
+     sparse matrix, so interpolating a layer is a sparse matrix vector product.  Source points that
+     are NaN in a layer are left out and the weights of the rest renormalised within the same
+     product.  Only cells left with no valid neighbour at all are searched again, among the valid
+     points of the layer, and the KD-tree of those points is kept for the next layers with the same
+     missing points (the same depth of another variable).
+    '''
+
+    def __init__(self, source_x, source_y, grid, power=2, neighbours=10):
+        from scipy import sparse
+        from scipy.spatial import cKDTree
+
+        self.grid = grid
+        self.power = power
+        self.source = np.column_stack((source_x, source_y)).astype(np.float64)
+        self.neighbours = min(int(neighbours), len(self.source))
+
+        target_y, target_x = grid.coordinates()
+        self.target = np.column_stack((target_x, target_y))
+
+        distance, index = cKDTree(self.source).query(self.target, self.neighbours)
+        distance = distance.reshape(len(self.target), self.neighbours)
+        index = index.reshape(len(self.target), self.neighbours)
+
+        indptr = np.arange(0, index.size + 1, self.neighbours)
+        shape = (len(self.target), len(self.source))
+        self.weights = sparse.csr_matrix((self.__weights(distance).ravel(), index.ravel(), indptr), shape=shape)
+        self.__trees = ValidPointTrees(self.source)
+
+    def __weights(self, distance):
+        # A cell sitting on a source point takes its value
+        return (1.0 / np.maximum(distance, 1e-12) ** self.power).astype(np.float32)
+
+    def interpolate(self, values):
+        '''
+         Interpolates one layer of source values (NaN where missing).  Returns a float32 array of
+         the grid shape, bottom row first, NaN where there are no valid source points.
+        '''
+        values = np.asarray(values, dtype=np.float64).ravel()
+        valid = np.isfinite(values)
+        numerator = self.weights.dot(np.where(valid, values, 0.0))
+        denominator = self.weights.dot(valid.astype(np.float64))
+
+        output = np.full(len(self.target), np.nan)
+        np.divide(numerator, denominator, out=output, where=denominator > 0)
+
+        # Cells whose neighbours are all missing look again among this layer's valid points
+        stranded = np.flatnonzero(denominator <= 0)
+        if len(stranded) and valid.any():
+            (tree, valid_index) = self.__trees.tree(valid)
+            neighbours = min(self.neighbours, len(valid_index))
+            distance, index = tree.query(self.target[stranded], neighbours)
+            distance = distance.reshape(len(stranded), neighbours)
+            index = index.reshape(len(stranded), neighbours)
+            weights = self.__weights(distance)
+            output[stranded] = (weights * values[valid_index][index]).sum(axis=1) / weights.sum(axis=1)
+
+        return output.reshape(self.grid.shape).astype(np.float32)
+
+
+class LocalSystemInterpolator(object):
+    '''
+     Base for interpolators whose estimate at a cell is a weighted sum of nearby source values with
+     the weights solved from a small linear system over the neighbourhood (ordinary kriging, tension
+     splines).  The weights only depend on where the points are, so they are solved once and reused:
+     cells whose neighbourhood is complete in a layer use the weights solved the first time, and the
+     inverted system of every neighbourhood met, including those left once missing values are taken
+     out, is cached, so further depths or variables on the same geometry skip the solving.  A cell
+     that loses neighbours to missing values keeps the rest, the missing points being masked out of
+     its system, so no new neighbour search is needed; only cells with no valid neighbour left are
+     searched again.  Systems are inverted in batches and the right hand sides of all cells sharing
+     a neighbourhood are solved together.  kernel(distance) gives the system entries between points
+     (a semivariogram, a spline basis), subclasses may give it as a _kernel method instead.
+    '''
+
+    def __init__(self, source_x, source_y, grid, neighbours=10, max_cached_systems=250000, chunk_size=65536,
+                 kernel=None):
+        from scipy.spatial import cKDTree
+
+        self.kernel = kernel if kernel is not None else getattr(self, "_kernel", None)
+        if self.kernel is None:
+            raise ValueError("A kernel is needed to interpolate with local systems")
+        self.grid = grid
+        self.source = np.column_stack((source_x, source_y)).astype(np.float64)
+        self.neighbours = min(int(neighbours), len(self.source))
+        self.max_cached_systems = max_cached_systems
+        self.chunk_size = chunk_size
+
+        target_y, target_x = grid.coordinates()
+        self.target = np.column_stack((target_x, target_y))
+        self.anchor = self._anchors()
+        self.index = self.__query(cKDTree(self.source), self.anchor, np.arange(len(self.source)))
+
+        self.__weights = None
+        self.__systems = OrderedDict()
+        self.__trees = ValidPointTrees(self.source)
+
+    def _anchors(self):
+        '''
+         Point each cell searches its neighbours from, the cell itself unless a subclass says so.
+        '''
+        return self.target
+
+    def _system(self, points):
+        '''
+         (count, n + 1, n + 1) system matrices for count neighbourhoods of n points (count, n, 2),
+         the kernel between the points bordered by the unbiasedness constraint.
+        '''
+        count, n = points.shape[0:2]
+        systems = np.ones((count, n + 1, n + 1))
+        systems[:, :n, :n] = self.kernel(np.sqrt(((points[:, :, np.newaxis, :] -
+                                                   points[:, np.newaxis, :, :]) ** 2).sum(axis=3)))
+        systems[:, n, n] = 0.0
+        return systems
+
+    def _rhs(self, points, targets):
+        '''
+         (count, n + 1) right hand sides for count cells (count, 2) and their neighbours (count, n, 2).
+        '''
+        rhs = np.ones((points.shape[0], points.shape[1] + 1))
+        rhs[:, :-1] = self.kernel(np.sqrt(((points - targets[:, np.newaxis, :]) ** 2).sum(axis=2)))
+        return rhs
+
+    def __query(self, tree, anchors, source_index):
+        neighbours = min(self.neighbours, len(source_index))
+        index = tree.query(anchors, neighbours)[1].reshape(len(anchors), neighbours)
+        return np.sort(source_index[index], axis=1)
+
+    @staticmethod
+    def __mask(systems, rhs, present):
+        '''
+         Takes the neighbours not present (index -1) out of systems and rhs: their rows and columns
+         are cleared and their diagonal set to 1, which leaves them a weight of 0 and the other
+         weights those of the system without them.
+        '''
+        n = present.shape[1]
+        if systems is not None:
+            systems[:, :n, :] = np.where(present[:, :, np.newaxis], systems[:, :n, :], 0.0)
+            systems[:, :, :n] = np.where(present[:, np.newaxis, :], systems[:, :, :n], 0.0)
+            diagonal = np.arange(n)
+            systems[:, diagonal, diagonal] = np.where(present, systems[:, diagonal, diagonal], 1.0)
+        if rhs is not None:
+            rhs[:, :n] = np.where(present, rhs[:, :n], 0.0)
+
+    def __inverses(self, sets):
+        inverses = np.empty((len(sets), sets.shape[1] + 1, sets.shape[1] + 1))
+        missing = []
+        for number, neighbourhood in enumerate(sets):
+            inverse = self.__systems.get(neighbourhood.tobytes())
+            if inverse is None:
+                missing.append(number)
+            else:
+                inverses[number] = inverse
+
+        if missing:
+            systems = self._system(self.source[sets[missing]])
+            self.__mask(systems, None, sets[missing] >= 0)
+            try:
+                solved = np.linalg.inv(systems)
+            except np.linalg.LinAlgError:
+                solved = np.linalg.pinv(systems)
+            inverses[missing] = solved
+            for number, inverse in zip(missing, solved):
+                self.__systems[sets[number].tobytes()] = inverse
+            while len(self.__systems) > self.max_cached_systems:
+                self.__systems.popitem(last=False)
+
+        return inverses
+
+    def __solve(self, index, targets):
+        '''
+         Weights (len(targets), n) for the cells in targets, whose neighbours are the rows of index
+         (sorted, -1 for a neighbour left out).
+        '''
+        weights = np.empty(index.shape, dtype=np.float32)
+        for start in range(0, len(targets), self.chunk_size):
+            chunk = slice(start, start + self.chunk_size)
+            sets, which = unique_rows(index[chunk])
+            rhs = self._rhs(self.source[index[chunk]], self.target[targets[chunk]])
+            self.__mask(None, rhs, index[chunk] >= 0)
+            solved = np.einsum("tij,tj->ti", self.__inverses(sets)[which], rhs)
+            weights[chunk] = solved[:, :index.shape[1]]
+        return weights
+
+    def interpolate(self, values):
+        '''
+         Interpolates one layer of source values (NaN where missing).  Returns a float32 array of
+         the grid shape, bottom row first.  Cells with missing neighbours use those left, cells with
+         none left their nearest valid source points.
+        '''
+        values = np.asarray(values, dtype=np.float64).ravel()
+        valid = np.isfinite(values)
+        output = np.full(len(self.target), np.nan)
+
+        complete = valid[self.index].all(axis=1)
+        if complete.any():
+            if self.__weights is None:
+                self.__weights = self.__solve(self.index, np.arange(len(self.target)))
+            output[complete] = (self.__weights[complete] * values[self.index[complete]]).sum(axis=1)
+
+        # The valid neighbours of each incomplete cell, missing ones as -1 so cells left with the
+        # same points share a system
+        incomplete = np.flatnonzero(~complete)
+        index = np.sort(np.where(valid[self.index[incomplete]], self.index[incomplete], -1), axis=1)
+        left = index[:, -1] >= 0
+        if left.any():
+            index = index[left]
+            output[incomplete[left]] = (self.__solve(index, incomplete[left]) *
+                                        np.where(index >= 0, values[index], 0.0)).sum(axis=1)
+
+        stranded = incomplete[~left]
+        if len(stranded) and valid.any():
+            (tree, valid_index) = self.__trees.tree(valid)
+            index = self.__query(tree, self.anchor[stranded], valid_index)
+            output[stranded] = (self.__solve(index, stranded) * values[index]).sum(axis=1)
+
+        return output.reshape(self.grid.shape).astype(np.float32)
+
+
+class KrigingInterpolator(LocalSystemInterpolator):
+    '''
+     Local ordinary kriging with a spherical semivariogram, the numpy version of Kriging_sa with
+     "Spherical" and a "VARIABLE n" search.  The semivariogram is fixed for the run rather than
+     fitted per layer, which is what lets the kriging systems be cached across depths and variables.
+     range_ defaults to twice the typical distance to the furthest of the n neighbours.  Without a
+     nugget the weights do not depend on the sill.
+    '''
+
+    def __init__(self, source_x, source_y, grid, neighbours=10, range_=None, nugget=0.0, sill=1.0, **kwargs):
+        super(KrigingInterpolator, self).__init__(source_x, source_y, grid, neighbours, **kwargs)
+
+        if range_ is None:
+            from scipy.spatial import cKDTree
+            sample = self.target[::max(1, len(self.target) // 10000)]
+            distance = cKDTree(self.source).query(sample, self.neighbours)[0].reshape(len(sample), -1)
+            range_ = 2.0 * float(np.median(distance[:, -1]))
+        self.range = max(range_, 1e-12)
+        self.nugget = nugget
+        self.sill = sill
+
+    def semivariogram(self, distance):
+        ratio = np.minimum(distance / self.range, 1.0)
+        gamma = self.nugget + (self.sill - self.nugget) * (1.5 * ratio - 0.5 * ratio ** 3)
+        return np.where(distance > 0, gamma, 0.0)
+
+    _kernel = semivariogram
+
+
+class SplineInterpolator(LocalSystemInterpolator):
+    '''
+     Regularised tension spline, the numpy version of Spline_sa with "TENSION".  As Spline_sa does
+     the output is cut into tiles and every cell of a tile is fitted from the same n source points
+     nearest the tile centre, so the neighbour list and spline system of a tile serve every depth.
+     weight is the tension weight (phi squared).  tile_cells is the tile side in output cells and
+     defaults to about the spacing of the source points.
+    '''
+
+    def __init__(self, source_x, source_y, grid, weight=0.1, neighbours=10, tile_cells=None, **kwargs):
+        if tile_cells is None:
+            from scipy.spatial import cKDTree
+            source = np.column_stack((source_x, source_y))
+            spacing = float(np.median(cKDTree(source).query(source, 2)[0][:, 1])) if len(source) > 1 else 0.0
+            tile_cells = spacing / min(grid.cell_width, grid.cell_height)
+        self.tile_cells = max(1, int(round(tile_cells)))
+        self.phi = np.sqrt(weight)
+
+        super(SplineInterpolator, self).__init__(source_x, source_y, grid, neighbours, **kwargs)
+
+    def _anchors(self):
+        rows, cols = np.divmod(np.arange(self.grid.size), self.grid.cols)
+        rows = np.minimum((rows // self.tile_cells + 0.5) * self.tile_cells, self.grid.rows) - 0.5
+        cols = np.minimum((cols // self.tile_cells + 0.5) * self.tile_cells, self.grid.cols) - 0.5
+        return np.column_stack((self.grid.x_min + (cols + 0.5) * self.grid.cell_width,
+                                self.grid.y_min + (rows + 0.5) * self.grid.cell_height))
+
+    def basis(self, distance):
+        from scipy.special import k0
+
+        scaled = np.maximum(distance * self.phi, 1e-12)
+        values = -(np.log(scaled / 2.0) + np.euler_gamma + k0(scaled)) / (2.0 * np.pi * self.phi ** 2)
+        return np.where(distance > 0, values, 0.0)
+
+    _kernel = basis
+
+
+class DataCube(object):
+    '''
+     Chunked depth x y x x store of a variable on local disk.  The cube is a directory holding
+     index.json (the depth levels, the GridDescriptor transform, the chunk shape and whether chunks
+     are compressed) and one file per chunk named <level chunk>_<row chunk>_<col chunk>.npy, or
+     .npz with compression.  Rows run bottom first as on the GridDescriptor.  Reads of a depth range
+     and window only open the chunks they overlap (uncompressed chunks are memory mapped), chunks
+     never written read as NaN.  Chunk files are written aside and moved into place.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, "index.json"), "r") as index_file:
+            index = json.load(index_file)
+        self.levels = np.asarray(index["levels"], dtype=np.float64)
+        self.grid = GridDescriptor.from_transform(index["transform"])
+        self.chunks = tuple(int(size) for size in index["chunks"])
+        self.compress = bool(index["compress"])
+        self.rebuilt = False
+
+    @staticmethod
+    def exists(path):
+        return os.path.exists(os.path.join(path, "index.json"))
+
+    @classmethod
+    def create(cls, path, levels, grid, chunks=(8, 256, 256), compress=False):
+        '''
+         Opens the cube at path, making it first if needed.  A cube left by a run with other levels,
+         another grid or other chunks is replaced, and rebuilt is set on the cube returned, as the
+         levels written into the old one are lost.
+        '''
+        index = OrderedDict([("format", "dsmtools-datacube"), ("version", 1),
+                             ("levels", [float(level) for level in levels]), ("transform", grid.transform),
+                             ("chunks", [int(size) for size in chunks]), ("compress", bool(compress)),
+                             ("dtype", "<f4")])
+        if cls.exists(path):
+            cube = cls(path)
+            if list(cube.levels) == index["levels"] and cube.grid == grid and list(cube.chunks) == index["chunks"] \
+                    and cube.compress == index["compress"]:
+                return cube
+            shutil.rmtree(path)
+            rebuilt = True
+        else:
+            rebuilt = False
+
+        os.makedirs(path)
+        with open(os.path.join(path, "index.json"), "w") as index_file:
+            json.dump(index, index_file, indent=1)
+        cube = cls(path)
+        cube.rebuilt = rebuilt
+        return cube
+
+    @property
+    def shape(self):
+        return (len(self.levels),) + self.grid.shape
+
+    def level_index(self, depth):
+        index = int(np.argmin(np.abs(self.levels - float(depth))))
+        if abs(self.levels[index] - float(depth)) > 0.5:
+            raise ValueError("Depth " + str(depth) + " is not in " + str(self.path))
+        return index
+
+    def __chunk_file(self, chunk):
+        return os.path.join(self.path, "_".join(str(number) for number in chunk) + (".npz" if self.compress else ".npy"))
+
+    def __read_chunk(self, chunk):
+        chunk_file = self.__chunk_file(chunk)
+        if not os.path.exists(chunk_file):
+            return None
+        if self.compress:
+            with np.load(chunk_file) as archive:
+                return archive["values"]
+        return np.load(chunk_file, mmap_mode="r")
+
+    def __write_chunk(self, chunk, values):
+        chunk_file = self.__chunk_file(chunk)
+        staging = chunk_file + ".tmp"
+        with open(staging, "wb") as out:
+            if self.compress:
+                np.savez_compressed(out, values=values)
+            else:
+                np.save(out, values)
+        replace_file(staging, chunk_file)
+
+    def __overlaps(self, start, stop):
+        '''
+         Chunks overlapping cells start to stop - 1 (level, row, col), with the slices of the chunk
+         and of the block start to stop that fall in each.
+        '''
+        ranges = []
+        for axis in range(3):
+            axis_ranges = []
+            for number in range(start[axis] // self.chunks[axis], (stop[axis] - 1) // self.chunks[axis] + 1):
+                low = max(start[axis], number * self.chunks[axis])
+                high = min(stop[axis], (number + 1) * self.chunks[axis])
+                axis_ranges.append((number, slice(low - number * self.chunks[axis], high - number * self.chunks[axis]),
+                                    slice(low - start[axis], high - start[axis])))
+            ranges.append(axis_ranges)
+        for level in ranges[0]:
+            for row in ranges[1]:
+                for col in ranges[2]:
+                    yield ((level[0], row[0], col[0]), (level[1], row[1], col[1]), (level[2], row[2], col[2]))
+
+    def __bounds(self, level_start, level_stop, window):
+        (row_start, row_stop, col_start, col_stop) = window or (0, self.grid.rows, 0, self.grid.cols)
+        level_stop = len(self.levels) if level_stop is None else level_stop
+        return (level_start, row_start, col_start), (level_stop, row_stop, col_stop)
+
+    def read(self, level_start=0, level_stop=None, window=None):
+        '''
+         float32 (level, row, col) array of levels level_start to level_stop - 1 over window
+         (row_start, row_stop, col_start, col_stop).
+        '''
+        start, stop = self.__bounds(level_start, level_stop, window)
+        values = np.full([stop[axis] - start[axis] for axis in range(3)], np.nan, dtype=np.float32)
+        for chunk, in_chunk, in_block in self.__overlaps(start, stop):
+            chunk_values = self.__read_chunk(chunk)
+            if chunk_values is not None:
+                values[in_block] = chunk_values[in_chunk]
+        return values
+
+    def write(self, values, level_start=0, window=None):
+        '''
+         Writes a (level, row, col) block at level_start and the top left corner of window (see
+         read), NaN for no data.  Chunks the block only partly covers keep their other cells.
+        '''
+        values = np.asarray(values, dtype=np.float32)
+        if values.ndim == 2:
+            values = values[np.newaxis]
+        if window is None:
+            window = (0, values.shape[1], 0, values.shape[2])
+        start, stop = self.__bounds(level_start, level_start + values.shape[0],
+                                    (window[0], window[0] + values.shape[1], window[2], window[2] + values.shape[2]))
+        for chunk, in_chunk, in_block in self.__overlaps(start, stop):
+            chunk_shape = [min(self.chunks[axis], self.shape[axis] - chunk[axis] * self.chunks[axis])
+                           for axis in range(3)]
+            chunk_values = self.__read_chunk(chunk)
+            chunk_values = np.full(chunk_shape, np.nan, dtype=np.float32) if chunk_values is None \
+                else np.array(chunk_values)
+            chunk_values[in_chunk] = values[in_block]
+            self.__write_chunk(chunk, chunk_values)
+
+    def write_level(self, depth, values):
+        self.write(values, self.level_index(depth))
+
+
+class DepthMaskStack(object):
+    '''
+     All depth masks of a bathymetry packed one bit per level per cell.  The stack is a directory
+     holding index.json (the depth levels and GridDescriptor transform) and masks.npy, a uint8
+     (byte, row, col) array with rows bottom first where bit k of a cell, most significant first
+     in byte k >> 3, is set when the cell reaches level k.  index.json also keeps the spatial
+     reference of the bathymetry, as a string for arcpy.SpatialReference.loadFromString.  masks.npy is memory mapped, so valid(k)
+     only reads the byte plane holding level k over the window asked for.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, "index.json"), "r") as index_file:
+            index = json.load(index_file)
+        self.levels = DepthLevels(index["levels"], index.get("name"))
+        self.grid = GridDescriptor.from_transform(index["transform"])
+        self.spatial_reference = index.get("spatial_reference")
+        self.masks = np.load(os.path.join(path, "masks.npy"), mmap_mode="r")
+
+    @staticmethod
+    def exists(path):
+        return os.path.exists(os.path.join(path, "index.json")) and os.path.exists(os.path.join(path, "masks.npy"))
+
+    @classmethod
+    def build(cls, path, levels, grid, index_blocks, spatial_reference=None):
+        '''
+         Writes the stack at path from (row_offset, index) strips of depth_level_index values, as
+         raster_blocks yields them, replacing any stack there.
+        '''
+        if not os.path.exists(path):
+            os.makedirs(path)
+        index = OrderedDict([("format", "dsmtools-depthmasks"), ("version", 1), ("name", levels.name),
+                             ("levels", levels.depths.tolist()), ("transform", grid.transform),
+                             ("spatial_reference", spatial_reference)])
+        staging = os.path.join(path, "masks.npy.tmp")
+        masks = np.lib.format.open_memmap(staging, mode="w+", dtype=np.uint8,
+                                          shape=((len(levels) + 7) // 8,) + grid.shape)
+        for row_offset, level_index in index_blocks:
+            for byte in range(masks.shape[0]):
+                bits = np.arange(byte * 8, byte * 8 + 8)[:, np.newaxis, np.newaxis]
+                masks[byte, row_offset:row_offset + level_index.shape[0]] = \
+                    np.packbits((level_index[np.newaxis] >= bits) & (bits < len(levels)), axis=0)[0]
+        masks.flush()
+        del masks
+
+        masks_file = os.path.join(path, "masks.npy")
+        replace_file(staging, masks_file)
+        with open(os.path.join(path, "index.json"), "w") as index_file:
+            json.dump(index, index_file, indent=1)
+        return cls(path)
+
+    def __window(self, plane, window):
+        (row_start, row_stop, col_start, col_stop) = window or (0, self.grid.rows, 0, self.grid.cols)
+        return plane[..., row_start:row_stop, col_start:col_stop]
+
+    def valid(self, k, window=None):
+        '''
+         Boolean (row, col) array of the cells reaching level k over window (row_start, row_stop,
+         col_start, col_stop).
+        '''
+        if not 0 <= k < len(self.levels):
+            raise IndexError("Level " + str(k) + " is not in " + str(self.path))
+        byte = self.__window(self.masks[k >> 3], window)
+        return (byte >> (7 - (k & 7))) & 1 == 1
+
+    def level_index(self, window=None):
+        '''
+         Deepest level index of every cell over window, -1 where no level is reached, the same
+         values as depth_level_index.  Masks are nested, so this is the number of bits set less one.
+        '''
+        bits = np.unpackbits(np.asarray(self.__window(self.masks, window)), axis=0)
+        return (bits.sum(axis=0, dtype=np.int16) - 1).astype(np.int16)
+
+
+class LayerStack(object):
+    '''
+     The depth layers of a variable written by the WOA extraction tools (<prefix><depth>), seen as a
+     (level, row, col) stack on one GridDescriptor and read by window.  directory may be a DataCube
+     (or hold one named prefix), which is then read chunk by chunk.  Otherwise a layer comes from its
+     binary XYZ dataset (<prefix><depth>.xyz, memory mapped, so a window read only touches its cells)
+     where there is one, or from the raster through arcpy.  Missing levels and NoData read as NaN.
+    '''
+
+    def __init__(self, directory, prefix, levels, no_data_value=349000000.0):
+        self.directory = directory
+        self.prefix = prefix
+        self.levels = np.asarray(levels, dtype=np.float64)
+        self.no_data_value = no_data_value
+        self.grid = None
+        self.__layers = []
+        self.__cube = None
+
+        for cube_path in [directory, os.path.join(directory, prefix)]:
+            if DataCube.exists(cube_path):
+                self.__cube = DataCube(cube_path)
+                self.grid = self.__cube.grid
+                for level in self.levels:
+                    try:
+                        self.__layers.append(self.__cube.level_index(level))
+                    except ValueError:
+                        self.__layers.append(None)
+                return
+
+        for level in self.levels:
+            name = os.path.join(directory, prefix + str(int(level)))
+            if xyz_exists(name + ".xyz"):
+                header, columns = read_xyz(name + ".xyz", ["z"])
+                layer_grid = GridDescriptor.from_transform(header["transform"])
+                layer = columns["z"].reshape(layer_grid.shape)
+            elif arcpy is not None and arcpy.Exists(name):
+                layer_grid = GridDescriptor.from_raster(name)
+                layer = name
+            else:
+                self.__layers.append(None)
+                continue
+            if self.grid is None:
+                self.grid = layer_grid
+            elif layer_grid != self.grid:
+                raise ValueError(name + " is not on the same grid as the other depth layers")
+            self.__layers.append(layer)
+
+        if self.grid is None:
+            raise ValueError("No depth layers for " + prefix + " in " + str(directory))
+
+    @property
+    def missing(self):
+        return [level for level, layer in zip(self.levels, self.__layers) if layer is None]
+
+    def read(self, window=None, level_start=0, level_stop=None):
+        '''
+         float32 (level, row, col) array of levels level_start to level_stop - 1 over window
+         (row_start, row_stop, col_start, col_stop), rows bottom first.
+        '''
+        (row_start, row_stop, col_start, col_stop) = window or (0, self.grid.rows, 0, self.grid.cols)
+        level_stop = len(self.levels) if level_stop is None else level_stop
+        stack = np.full((level_stop - level_start, row_stop - row_start, col_stop - col_start), np.nan,
+                        dtype=np.float32)
+
+        if self.__cube is not None:
+            # One read over the cube levels the requested ones span
+            found = [(number, layer) for number, layer in enumerate(self.__layers[level_start:level_stop])
+                     if layer is not None]
+            if found:
+                first = min(layer for number, layer in found)
+                values = self.__cube.read(first, max(layer for number, layer in found) + 1,
+                                          (row_start, row_stop, col_start, col_stop))
+                for number, layer in found:
+                    stack[number] = values[layer - first]
+            return stack
+
+        for number, layer in enumerate(self.__layers[level_start:level_stop]):
+            if layer is None:
+                continue
+            if isinstance(layer, np.ndarray):
+                values = layer[row_start:row_stop, col_start:col_stop]
+            else:
+                values = np.flipud(arcpy.RasterToNumPyArray(
+                    layer, arcpy.Point(self.grid.x_min + col_start * self.grid.cell_width,
+                                       self.grid.y_min + row_start * self.grid.cell_height),
+                    col_stop - col_start, row_stop - row_start, self.no_data_value))
+            stack[number] = values
+        stack[stack == np.float32(self.no_data_value)] = np.nan
+        return stack
+
+    def positions(self, x, y):
+        '''
+         Fractional (row, col) of points on the stack grid, cell centres on whole numbers.
+        '''
+        return ((np.asarray(y, dtype=np.float64) - self.grid.y_min) / self.grid.cell_height - 0.5,
+                (np.asarray(x, dtype=np.float64) - self.grid.x_min) / self.grid.cell_width - 0.5)
+
+
+def trilinear_interpolate(stack, levels, row, col, depth):
+    '''
+     Samples a (level, row, col) stack at fractional row and col (cell centres on whole numbers) and
+     depth (in the units of levels, a DepthLevels or ascending array), all arrays of the same
+     length.  Values are bilinear within the two levels bracketing each depth and linear
+     between them.  Corners without data are left out and the other weights rescaled, so cells by
+     the coast or the seabed still get a value.  Positions with no corner holding data or a NaN depth
+     are NaN, and positions beyond the edges or levels of the stack take the nearest value.
+    '''
+    if not isinstance(levels, DepthLevels):
+        levels = DepthLevels(levels)
+
+    def bracket(position, count):
+        position = np.clip(position, 0, count - 1)
+        lower = np.minimum(np.floor(position).astype(np.intp), max(count - 2, 0))
+        upper = np.minimum(lower + 1, count - 1)
+        return lower, upper, np.where(upper > lower, position - lower, 0.0)
+
+    row0, row1, row_fraction = bracket(np.asarray(row, dtype=np.float64), stack.shape[1])
+    col0, col1, col_fraction = bracket(np.asarray(col, dtype=np.float64), stack.shape[2])
+
+    level0, level1, level_fraction = levels.weights(depth)
+    # NaN depths come back with -1 levels, which would read the last level
+    missing = level0 < 0
+    level0, level1 = np.where(missing, 0, level0), np.where(missing, 0, level1)
+
+    total = np.zeros(level_fraction.shape)
+    weights = np.zeros(level_fraction.shape)
+    for level, level_weight in ((level0, 1.0 - level_fraction), (level1, level_fraction)):
+        for row_index, row_weight in ((row0, 1.0 - row_fraction), (row1, row_fraction)):
+            for col_index, col_weight in ((col0, 1.0 - col_fraction), (col1, col_fraction)):
+                values = stack[level, row_index, col_index]
+                valid = np.isfinite(values)
+                weight = np.where(valid, level_weight * row_weight * col_weight, 0.0)
+                total += np.where(valid, values, 0.0) * weight
+                weights += weight
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return np.where((weights > 0) & ~missing, total / weights, np.nan).astype(np.float32)
+
+
+# Process start methods the multiprocessing tools offer, those of this Python only, as Python 2
+# (ArcMap) can only fork and on Windows has the default alone.  worker_pool also takes "thread", left
+# out here as the tasks of those tools call arcpy, which is not thread safe
+if hasattr(multiprocessing, "get_all_start_methods"):
+    POOL_METHODS = ["Default"] + multiprocessing.get_all_start_methods()
+elif os.name == "posix":
+    POOL_METHODS = ["Default", "fork"]
+else:
+    POOL_METHODS = ["Default"]
+
+
+def worker_pool(processes, method=None, initializer=None, initargs=()):
+    '''
+     Pool of workers for the multiprocessing tools.  method is one of POOL_METHODS: "fork", "spawn"
+     or "forkserver" process pools, or "Default"/None for the platform default, or "thread" for
+     stages that make no arcpy calls.  Under ArcGIS on Windows the workers are started with pythonw.exe, as
+     sys.executable is ArcMap itself.  initializer(*initargs) runs once in every worker.
+    '''
+    processes = max(1, int(processes))
+    if method == "thread":
+        from multiprocessing.pool import ThreadPool
+        return ThreadPool(processes, initializer, initargs)
+
+    if method in (None, "", "Default"):
+        context = multiprocessing
+    elif hasattr(multiprocessing, "get_context"):
+        context = multiprocessing.get_context(method)
+    elif method == "fork" and os.name == "posix":
+        context = multiprocessing
+    else:
+        raise ValueError("The " + str(method) + " worker pool needs Python 3.4 or later")
+
+    if sys.platform == "win32":
+        python_exe = os.path.join(sys.exec_prefix, 'pythonw.exe')
+        if os.path.exists(python_exe):
+            context.set_executable(python_exe)
+
+    return context.Pool(processes, initializer, initargs)
+
+
+class TemporalAggregator(object):
+    '''
+     Running mean, minimum, maximum and range over a series of layers (the months of a monthly
+     climatology, say) added one at a time.  Only the running count, sum, minimum and maximum are
+     kept, never the layers.  Cells without data in any layer are NaN.  SUFFIXES are short enough to
+     keep raster names within the 13 characters of an ESRI GRID.
+    '''
+
+    STATISTICS = ["mean", "min", "max", "range"]
+    SUFFIXES = {"mean": "avg", "min": "min", "max": "max", "range": "rng"}
+
+    def __init__(self):
+        self.layers = 0
+        self.count = None
+        self.sum = None
+        self.minimum = None
+        self.maximum = None
+
+    def add(self, values):
+        values = np.asarray(values, dtype=np.float64)
+        valid = np.isfinite(values)
+        if self.count is None:
+            self.count = np.zeros(values.shape, dtype=np.int32)
+            self.sum = np.zeros(values.shape)
+            self.minimum = np.full(values.shape, np.nan)
+            self.maximum = np.full(values.shape, np.nan)
+        self.layers += 1
+        self.count += valid
+        self.sum += np.where(valid, values, 0.0)
+        np.fmin(self.minimum, values, out=self.minimum)
+        np.fmax(self.maximum, values, out=self.maximum)
+
+    def result(self, statistic):
+        if statistic == "mean":
+            values = np.where(self.count > 0, self.sum / np.maximum(self.count, 1), np.nan)
+        elif statistic == "min":
+            values = self.minimum
+        elif statistic == "max":
+            values = self.maximum
+        elif statistic == "range":
+            values = self.maximum - self.minimum
+        else:
+            raise ValueError("Unknown statistic " + str(statistic))
+        return values.astype(np.float32)
+
+
+def longest_first(tasks, costs):
+    '''
+     Orders tasks by decreasing cost.  Handed to imap_unordered one at a time, the long tasks start
+     first and idle workers pick up the short ones, so the run does not wait on a late long task.
+    '''
+    order = np.argsort(-np.asarray(costs, dtype=np.float64), kind="mergesort")
+    return [tasks[number] for number in order]
+
+
+def worker_name():
+    '''
+     Name of the process, and thread in a thread pool, a task runs in.
+    '''
+    name = multiprocessing.current_process().name
+    if threading.current_thread().name != "MainThread":
+        name += "/" + threading.current_thread().name
+    return name
+
+
+class WorkerUtilization(object):
+    '''
+     Collects the start and end time.time() of the tasks run by each worker and reports how busy
+     each worker was over the run.  workers is the size of the pool, so workers that never got a
+     task count as idle in the mean.
+    '''
+
+    def __init__(self, workers=None):
+        self.workers = workers
+        self.start = time.time()
+        self.busy = OrderedDict()
+        self.tasks = OrderedDict()
+
+    def record(self, worker, start, end):
+        self.busy[worker] = self.busy.get(worker, 0.0) + max(0.0, end - start)
+        self.tasks[worker] = self.tasks.get(worker, 0) + 1
+
+    def report(self):
+        elapsed = max(time.time() - self.start, 1e-9)
+        lines = []
+        for worker in self.busy:
+            lines.append(worker + ": " + str(self.tasks[worker]) + " tasks, busy " +
+                         str(round(self.busy[worker], 1)) + " s (" +
+                         str(int(round(100.0 * self.busy[worker] / elapsed))) + "% of " +
+                         str(round(elapsed, 1)) + " s)")
+        workers = max(self.workers or 0, len(self.busy))
+        if workers > len(self.busy):
+            lines.append(str(workers - len(self.busy)) + " of " + str(workers) + " workers ran no tasks")
+        if workers:
+            lines.append("Mean utilization " + str(int(round(100.0 * sum(self.busy.values()) /
+                                                             (elapsed * workers)))) + "%")
+        return lines
+
+
+class TaskResult(dict):
+    '''
+     Result record of a worker task: the task, its status ("running", "done" or "failed"), the stage
+     it reached, the seconds spent in each stage, the outputs written and the error traceback.  It is
+     a dict, so it pickles back from the workers as is and goes straight into a RunManifest.
+    '''
+
+    def __init__(self, task):
+        dict.__init__(self, task=task, status="running", stage="Started", timings=OrderedDict(), outputs=[],
+                      error=None, worker=worker_name(), start=time.time(), end=None)
+        self.stage_start = self["start"]
+
+    def stage(self, name):
+        now = time.time()
+        if self.stage_start is not None:
+            self["timings"][self["stage"]] = self["timings"].get(self["stage"], 0.0) + now - self.stage_start
+        self["stage"] = name
+        self.stage_start = now
+
+    def output(self, path):
+        if path not in self["outputs"]:
+            self["outputs"].append(path)
+        return path
+
+    def fail(self):
+        self["status"] = "failed"
+        self["error"] = traceback.format_exc()
+        self.finish()
+
+    def finish(self):
+        '''
+         Closes the current stage.  end keeps the time the task first finished, so stages added
+         afterwards (post-processing) do not count towards the worker time.
+        '''
+        self.stage(self["stage"])
+        self.stage_start = None
+        if self["status"] == "running":
+            self["status"] = "done"
+        if self["end"] is None:
+            self["end"] = time.time()
+        return self
+
+    @property
+    def failed(self):
+        return self["status"] == "failed"
+
+
+class RunManifest(object):
+    '''
+     Record of the tasks of a run kept as JSON (run_manifest.json in the output directory) with the
+     last TaskResult of each task.  signature describes the settings of the run, and the optional
+     task_signature(task) the inputs of a single task (say the file its variable comes from).  A task
+     is only pending on a rerun if it failed, never ran, ran under another signature or lost one of
+     its outputs, so a rerun picks up where the last one left off.
+    '''
+
+    def __init__(self, path, signature, task_signature=None):
+        self.path = path
+        self.signature = json.loads(json.dumps(signature))
+        self.task_signature = task_signature
+        self.tasks = OrderedDict()
+        if os.path.exists(path):
+            try:
+                with open(path) as manifest:
+                    self.tasks = json.load(manifest, object_pairs_hook=OrderedDict).get("tasks", OrderedDict())
+            except ValueError:
+                pass
+
+    @staticmethod
+    def input_signature(path):
+        '''
+         Path, size and modification time of an input file.
+        '''
+        return list(NetCDFMetadataCache.key(path))
+
+    @staticmethod
+    def task_key(task):
+        if isinstance(task, (tuple, list)):
+            return "/".join(str(part) for part in task)
+        return str(task)
+
+    def entry(self, task):
+        return self.tasks.get(self.task_key(task))
+
+    def signature_of(self, task):
+        if self.task_signature is None:
+            return self.signature
+        return json.loads(json.dumps([self.signature, self.task_signature(task)]))
+
+    def is_done(self, task):
+        entry = self.entry(task)
+        return entry is not None and entry.get("status") == "done" and \
+            entry.get("signature") == self.signature_of(task) and \
+            all(os.path.exists(output) for output in entry.get("outputs", []))
+
+    def pending(self, tasks):
+        return [task for task in tasks if not self.is_done(task)]
+
+    def forget(self, output):
+        '''
+         Drops the tasks that wrote output, so they are pending again when output was made anew.
+        '''
+        for key in [key for key, entry in self.tasks.items() if output in entry.get("outputs", [])]:
+            del self.tasks[key]
+
+    def record(self, result):
+        entry = json.loads(json.dumps(result), object_pairs_hook=OrderedDict)
+        entry["signature"] = self.signature_of(result["task"])
+        self.tasks[self.task_key(result["task"])] = entry
+
+    def save(self):
+        # Written aside and moved over the old manifest, so a crash never leaves half a file
+        staging = self.path + ".tmp"
+        with open(staging, "w") as manifest:
+            json.dump(OrderedDict([("signature", self.signature), ("tasks", self.tasks)]), manifest, indent=1)
+        replace_file(staging, self.path)
+
+
+class ReprojectionCache(object):
+    '''
+     Content addressed cache of rasters brought onto another grid (reprojected and resampled), kept
+     in directory as GeoTIFFs with an index.json.  An entry is keyed by a hash of the files of the
+     source raster together with the target spatial reference, cell size, resampling method and
+     grid, so a rerun over unchanged layers reuses them whatever they are called, and a changed
+     layer is made again.  File hashes are remembered by path, size and modification time, so
+     unchanged sources are not read again.  Once the entries pass max_size bytes save() deletes
+     the least recently used, leaving those fetched by this run in place.
+    '''
+
+    def __init__(self, directory, max_size=10 * 1024 ** 3):
+        self.directory = directory
+        self.max_size = max_size
+        self.path = os.path.join(directory, "index.json")
+        self.entries = OrderedDict()
+        self.file_hashes = {}
+        self.pinned = set()
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        if os.path.exists(self.path):
+            try:
+                with open(self.path) as index_file:
+                    index = json.load(index_file, object_pairs_hook=OrderedDict)
+                self.entries = index.get("entries", OrderedDict())
+                self.file_hashes = index.get("files", {})
+            except ValueError:
+                pass
+
+    @staticmethod
+    def source_files(raster):
+        '''
+         Files holding a raster: every file of an ESRI GRID folder, or a file and the files beside
+         it sharing its name (world files, .aux.xml), None for rasters inside a geodatabase.
+        '''
+        if os.path.isdir(raster):
+            return sorted(os.path.join(folder, name) for folder, folders, names in os.walk(raster) for name in names)
+        if os.path.isfile(raster):
+            (folder, name) = os.path.split(os.path.abspath(raster))
+            stem = os.path.splitext(name)[0]
+            return sorted(os.path.join(folder, other) for other in os.listdir(folder)
+                          if other == stem or other.startswith(stem + "."))
+        return None
+
+    def file_hash(self, path):
+        memo = "|".join(str(part) for part in NetCDFMetadataCache.key(path))
+        if memo not in self.file_hashes:
+            digest = hashlib.sha1()
+            with open(path, "rb") as source:
+                for block in iter(lambda: source.read(1048576), b""):
+                    digest.update(block)
+            self.file_hashes[memo] = digest.hexdigest()
+        return self.file_hashes[memo]
+
+    def key(self, source, spatial_reference, cell_size, resampling, grid=None):
+        '''
+         Cache key of source brought onto spatial_reference (a string such as exportToString gives),
+         or None where the files of source can not be found.
+        '''
+        files = self.source_files(source)
+        if not files:
+            return None
+        digest = hashlib.sha1()
+        for path in files:
+            digest.update((os.path.relpath(path, os.path.dirname(os.path.abspath(source))) + ":" +
+                           self.file_hash(path) + ";").encode("utf-8"))
+        digest.update(json.dumps([spatial_reference, float(cell_size), resampling,
+                                  None if grid is None else grid.transform]).encode("utf-8"))
+        return digest.hexdigest()
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        raster = os.path.join(self.directory, entry["raster"])
+        if not os.path.exists(raster):
+            del self.entries[key]
+            return None
+        self.entries[key] = self.entries.pop(key)
+        return raster
+
+    def put(self, key, raster):
+        size = sum(os.path.getsize(path) for path in self.source_files(raster) or [])
+        self.entries.pop(key, None)
+        self.entries[key] = OrderedDict([("raster", os.path.basename(raster)), ("size", size)])
+        return raster
+
+    def evict(self):
+        '''
+         Deletes the least recently used entries until the cache fits in max_size, other than those
+         pinned by fetch, which the current run still reads.
+        '''
+        size = sum(entry["size"] for entry in self.entries.values())
+        for key in [key for key in self.entries if key not in self.pinned]:
+            if size <= self.max_size:
+                break
+            entry = self.entries.pop(key)
+            arcpy.Delete_management(os.path.join(self.directory, entry["raster"]))
+            size -= entry["size"]
+
+    def fetch(self, source, spatial_reference, cell_size, resampling, grid, make):
+        '''
+         Path of source brought onto the grid, from the cache or made with make(output), which
+         writes the raster output.  Sources the cache can not hash are made again every time.
+        '''
+        key = self.key(source, spatial_reference, cell_size, resampling, grid)
+        if key is not None:
+            self.pinned.add(key)
+            raster = self.get(key)
+            if raster is not None:
+                return raster
+        raster = os.path.join(self.directory, "r" + (key or hashlib.sha1(source.encode("utf-8")).hexdigest())[:24] + ".tif")
+        make(staging_name(raster))
+        publish_raster(staging_name(raster), raster)
+        if key is None:
+            return raster
+        return self.put(key, raster)
+
+    def save(self):
+        self.evict()
+
+        # Hashes of files since changed or removed are dropped
+        for memo in list(self.file_hashes):
+            try:
+                current = "|".join(str(part) for part in NetCDFMetadataCache.key(memo.rsplit("|", 2)[0]))
+            except OSError:
+                current = None
+            if current != memo:
+                del self.file_hashes[memo]
+
+        staging = self.path + ".tmp"
+        with open(staging, "w") as index_file:
+            json.dump(OrderedDict([("entries", self.entries), ("files", self.file_hashes)]), index_file, indent=1)
+        replace_file(staging, self.path)
+
+
+def xyz_block(raster_values, grid, no_data_value, row_offset=0, skip_no_data=True):
+    '''
+     Builds the y, x, z columns for a strip of raster values (bottom row first, as in the flipped
+     array used by raster_to_xyz) on the GridDescriptor grid.  row_offset is the number of rows below
+     the strip.  Cells holding the NoData value (or NaN) are dropped unless skip_no_data is False.
+    '''
+    values = raster_values.ravel()
+    if skip_no_data:
+        valid = np.isfinite(values)
+        if no_data_value is not None:
+            valid &= values != no_data_value
+        index = np.flatnonzero(valid)
+    else:
+        index = np.arange(values.size)
+
+    y, x = grid.coordinates(index + row_offset * grid.cols)
+
+    return y, x, values[index]
+
+
+def write_xyz_block(out, y, x, z):
+    '''
+     Writes a block of y, x, z columns to a text file in one go.
+    '''
+    # One format call per block rather than one per row, which is what np.savetxt does
+    block = np.column_stack((y, x, z)).ravel().tolist()
+    out.write((("%.15g %.15g %.15g\n" * len(z)) % tuple(block)).encode("ascii"))
+    return len(z)
+
+
+class XYZWriter(object):
+    '''
+     Writes a binary columnar XYZ dataset.  The dataset is a directory holding one little endian
+     float32 file per column (y.f32, x.f32, z.f32) and a header.json with the column names, cell
+     count, NoData value and the GridDescriptor transform (x_min, cell width, y_min, cell height,
+     rows, cols).  Rows are stored bottom up.  A dense dataset (every cell kept) only needs the z
+     column, coordinates then come from the grid.  The header is written on close, so a dataset
+     without a header is an unfinished one.
+    '''
+
+    def __init__(self, path, grid, no_data_value, columns=("y", "x", "z")):
+        if not os.path.exists(path):
+            os.makedirs(path)
+        header_file = os.path.join(path, "header.json")
+        if os.path.exists(header_file):
+            os.remove(header_file)
+
+        self.path = path
+        self.grid = grid
+        self.no_data_value = no_data_value
+        self.columns = list(columns)
+        self.count = 0
+        self.__handles = [open(os.path.join(path, column + ".f32"), "wb") for column in self.columns]
+
+    def write(self, *arrays):
+        for handle, array in zip(self.__handles, arrays):
+            np.asarray(array, dtype="<f4").tofile(handle)
+        self.count += len(arrays[0])
+        return len(arrays[0])
+
+    def close(self):
+        for handle in self.__handles:
+            handle.close()
+        header = {"format": "dsmtools-xyz",
+                  "version": 1,
+                  "dtype": "<f4",
+                  "columns": self.columns,
+                  "count": self.count,
+                  "no_data_value": self.no_data_value,
+                  "transform": self.grid.transform,
+                  "dense": self.count == self.grid.size}
+        with open(os.path.join(self.path, "header.json"), "w") as header_file:
+            json.dump(header, header_file, indent=1)
+
+    def abort(self):
+        '''
+         Closes the column files and deletes them, leaving no dataset behind.
+        '''
+        for handle in self.__handles:
+            handle.close()
+        for column in self.columns:
+            column_file = os.path.join(self.path, column + ".f32")
+            if os.path.exists(column_file):
+                os.remove(column_file)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+def read_xyz(path, columns=None):
+    '''
+     Opens a binary columnar XYZ dataset written by XYZWriter.  Returns (header, arrays) where
+     arrays maps each column name to a read only np.memmap, so nothing is copied until used.  For a
+     dense dataset z.reshape(rows, cols) is the raster, bottom row first, and
+     GridDescriptor.from_transform(header["transform"]) gives the coordinates.
+    '''
+    with open(os.path.join(path, "header.json"), "r") as header_file:
+        header = json.load(header_file)
+
+    arrays = {}
+    for column in (columns or header["columns"]):
+        if header["count"] == 0:
+            arrays[column] = np.zeros(0, dtype=header["dtype"])
+        else:
+            arrays[column] = np.memmap(os.path.join(path, column + ".f32"), dtype=header["dtype"], mode="r",
+                                       shape=(header["count"],))
+    return header, arrays
+
+
+def xyz_exists(path):
+    return os.path.exists(os.path.join(path, "header.json"))
+
+
+def array_to_xyz(raster_values, raster_x_min, raster_y_min, raster_cw, raster_ch, output_file, no_data_value,
+                 binary=False, block_rows=256):
+    '''
+     Writes the y, x, z triples of a raster array (top row first, as returned by RasterToNumPyArray)
+     to output_file, as text or as a binary XYZ dataset.  Rows are written bottom up, block_rows at a
+     time, skipping NoData cells.  Returns the number of cells written.
+    '''
+    raster_values = np.flipud(raster_values)
+    (height, width) = raster_values.shape
+    grid = GridDescriptor(raster_x_min, raster_y_min, raster_cw, raster_ch, height, width)
+    written = 0
+
+    if binary:
+        out = XYZWriter(output_file, grid, no_data_value)
+    else:
+        out = open(output_file, "wb")
+
+    with out:
+        for row in range(0, height, block_rows):
+            y, x, z = xyz_block(raster_values[row:row + block_rows], grid, no_data_value, row)
+            if binary:
+                written += out.write(y, x, z)
+            else:
+                written += write_xyz_block(out, y, x, z)
+
+    return written
+
+
+def raster_blocks(raster, no_data_value, block_size=1048576, grid=None):
+    '''
+     Generator reading a raster as strips of whole rows, bottom strip first, each holding at most
+     block_size cells (at least one row).  Yields (row_offset, values) where values is flipped so
+     its first row is the lowest, and row_offset counts the rows below the strip.  Only one strip
+     is held in memory at a time.
+    '''
+    if grid is None:
+        grid = GridDescriptor.from_raster(raster)
+
+    block_rows = max(1, int(block_size) // grid.cols)
+
+    for row in range(0, grid.rows, block_rows):
+        rows = min(block_rows, grid.rows - row)
+        yield row, read_raster_strip(raster, grid, row, rows, no_data_value)
+
+
+def read_raster_strip(raster, grid, row, rows, no_data_value):
+    '''
+     Rows row to row + rows - 1 of a raster on grid, flipped so the first row is the lowest.
+    '''
+    return np.flipud(arcpy.RasterToNumPyArray(raster, arcpy.Point(grid.x_min, grid.y_min + (row * grid.cell_height)),
+                                              grid.cols, rows, no_data_value))
+
+
+def iter_xyz(raster, no_data_value, block_size=1048576, skip_no_data=True, grid=None):
+    '''
+     Generator yielding (y, x, z) column arrays for a raster one strip at a time.  Centroids are
+     computed from the raster origin and cell size for each strip, so peak memory depends on
+     block_size and not on the size of the raster.
+    '''
+    if grid is None:
+        grid = GridDescriptor.from_raster(raster)
+
+    for row_offset, values in raster_blocks(raster, no_data_value, block_size, grid):
+        yield xyz_block(values, grid, no_data_value, row_offset, skip_no_data)
+
+
+def raster_to_xyz(raster, raster_name, output, no_data_value, binary=False, block_size=1048576,
+                  skip_no_data=True, coordinates=True):
+    '''
+     Writes the cell centroids and values of a raster to output as raster_name.yxz (space delimited
+     text) or, with binary, as the raster_name.xyz binary columnar dataset (see XYZWriter).  With
+     skip_no_data False every cell is kept, so datasets from rasters on the same grid line up, and
+     coordinates False then leaves the y and x columns out of a binary dataset, the shared
+     GridDescriptor gives them back.
+    '''
+    grid = GridDescriptor.from_raster(raster)
+
+    (y_max, x_max) = grid.centroid(grid.rows, grid.cols)
+    coordinates_y = float(y_max)
+    coordinates_x = float(x_max)
+
+    # Stream the raster a strip at a time, NoData cells come back as no_data_value
+    if binary:
+        columns = ("y", "x", "z") if coordinates else ("z",)
+        out = XYZWriter(os.path.join(output, str(raster_name) + ".xyz"), grid, no_data_value, columns)
+    else:
+        out = open(os.path.join(output, str(raster_name) + ".yxz"), "wb")
+
+    with out:
+        for y, x, z in iter_xyz(raster, no_data_value, block_size, skip_no_data, grid):
+            if binary:
+                out.write(*((y, x, z) if coordinates else (z,)))
+            else:
+                write_xyz_block(out, y, x, z)
 
-    del raster_values, raster_values_full, raster_coordinates,
     gc.collect()
 
     return coordinates_x, coordinates_y
@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+# Compares the old cell by cell csv writer of raster_to_xyz with array_to_xyz on a synthetic grid
+# with a third of the cells set to NoData, and reports cells/second for each writer.  Run with:
+# python tests/benchmark_raster_to_xyz.py [height] [width]
+import csv
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Tools"))
+
+from Includes import array_to_xyz
+
+
+def benchmark_raster_to_xyz(height=1000, width=2000, output=None):
+    no_data_value = 349000000.0
+    raster_values = np.random.random_sample((height, width)).astype(np.float32) * 30.0
+    raster_values[np.random.random_sample((height, width)) < 0.33] = no_data_value
+
+    temp_directory = tempfile.mkdtemp() if output is None else output
+    results = {}
+
+    try:
+        # The writer raster_to_xyz used before, kept here as the baseline
+        start = time.time()
+        flipped = np.flipud(raster_values)
+        with open(os.path.join(temp_directory, "loop.yxz"), "wb" if sys.version_info[0] < 3 else "w") as handle:
+            out = csv.writer(handle, delimiter=' ', quoting=csv.QUOTE_NONNUMERIC)
+            for row in range(0, height):
+                for col in range(0, width):
+                    out.writerow([0.5 + row, 0.5 + col, flipped[row, col]])
+        results["loop"] = (height * width) / (time.time() - start)
+
+        start = time.time()
+        array_to_xyz(raster_values, 0, 0, 1, 1, os.path.join(temp_directory, "bulk.yxz"), no_data_value)
+        results["text"] = (height * width) / (time.time() - start)
+
+        start = time.time()
+        array_to_xyz(raster_values, 0, 0, 1, 1, os.path.join(temp_directory, "bulk.xyz"), no_data_value, True)
+        results["binary"] = (height * width) / (time.time() - start)
+    finally:
+        if output is None:
+            shutil.rmtree(temp_directory)
+
+    return results
+
+
+def main():
+    results = benchmark_raster_to_xyz(*[int(size) for size in sys.argv[1:3]])
+    for writer in ["loop", "text", "binary"]:
+        print("raster_to_xyz " + writer + " writer: " + str(int(results[writer])) + " cells/second")
+
+
+if __name__ == '__main__':
+    main()
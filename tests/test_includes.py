@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+# Checks of the numpy helpers in Tools/Includes.py, these need no ArcGIS.  Run from the repository
+# folder with: python -m unittest discover tests
+import os
+import sys
+import unittest
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Tools"))
+
+from Includes import DepthLevels
+from Includes import GridDescriptor
+from Includes import composite_levels
+from Includes import depth_level_index
+from Includes import interpolate_levels
+from Includes import load_depth_string
+from Includes import xyz_block
+
+NO_DATA = 349000000.0
+
+
+class XYZBlockTest(unittest.TestCase):
+
+    def setUp(self):
+        self.grid = GridDescriptor(100, 200, 2, 1, 2, 3)
+
+    def test_skips_no_data(self):
+        values = np.array([[1.0, 2.0, NO_DATA], [4.0, np.nan, 6.0]])
+        y, x, z = xyz_block(values, self.grid, NO_DATA)
+        np.testing.assert_allclose(y, [200.5, 200.5, 201.5, 201.5])
+        np.testing.assert_allclose(x, [101, 103, 101, 105])
+        np.testing.assert_allclose(z, [1, 2, 4, 6])
+
+    def test_row_offset(self):
+        y, x, z = xyz_block(np.array([[1.0, 2.0, 3.0]]), self.grid, NO_DATA, row_offset=1)
+        np.testing.assert_allclose(y, [201.5, 201.5, 201.5])
+        np.testing.assert_allclose(x, [101, 103, 105])
+
+    def test_keeps_no_data(self):
+        y, x, z = xyz_block(np.array([[1.0, 2.0, NO_DATA]]), self.grid, NO_DATA, skip_no_data=False)
+        self.assertEqual(len(z), 3)
+        self.assertEqual(z[2], NO_DATA)
+
+
+class DepthLevelsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.levels = DepthLevels([0, 10, 20])
+
+    def test_weights(self):
+        lower, upper, weight = self.levels.weights(np.array([5.0, 10.0, 25.0, -1.0]))
+        np.testing.assert_array_equal(lower, [0, 1, 2, 0])
+        np.testing.assert_array_equal(upper, [1, 2, 2, 0])
+        np.testing.assert_allclose(weight, [0.5, 0.0, 0.0, 0.0])
+
+    def test_weights_of_nan_depths(self):
+        lower, upper, weight = self.levels.weights(np.array([np.nan]))
+        self.assertEqual((lower[0], upper[0], weight[0]), (-1, -1, 0.0))
+
+    def test_rejects_unsorted_or_repeated_levels(self):
+        self.assertRaises(ValueError, DepthLevels, [10, 0, 20])
+        self.assertRaises(ValueError, DepthLevels, [0, 10, 10])
+        self.assertRaises(ValueError, DepthLevels, [])
+
+    def test_standard_sets_are_shared(self):
+        self.assertIs(DepthLevels.get("WOA18"), DepthLevels.get("WOA18"))
+        self.assertEqual(len(DepthLevels.get("WOA05")), 33)
+
+    def test_depth_strings_keep_custom_order(self):
+        self.assertEqual(load_depth_string("WOA05")[:3], ["0", "10", "20"])
+        self.assertEqual(load_depth_string("20, 10,10"), ["20", "10", "10"])
+        self.assertEqual(load_depth_string(" "), [])
+
+
+class DepthLevelIndexTest(unittest.TestCase):
+
+    def test_index(self):
+        bathymetry = np.array([[5.0, -5.0, -15.0], [-25.0, NO_DATA, np.nan]])
+        index = depth_level_index(bathymetry, DepthLevels([0, 10, 20]), NO_DATA)
+        self.assertEqual(index.dtype, np.int16)
+        np.testing.assert_array_equal(index, [[-1, 0, 1], [2, -1, -1]])
+
+
+class CompositeLevelsTest(unittest.TestCase):
+
+    def test_takes_level_of_each_cell(self):
+        stack = np.arange(3, dtype=np.float64).reshape(3, 1, 1) * np.ones((3, 1, 4))
+        values = composite_levels(stack, np.array([[-1, 0, 1, 2]]))
+        np.testing.assert_array_equal(values, [[np.nan, 0, 1, 2]])
+
+    def test_falls_back_to_shallower_level_with_data(self):
+        stack = np.array([[[1.0, np.nan]], [[np.nan, np.nan]], [[np.nan, 3.0]]])
+        values = composite_levels(stack, np.array([[2, 1]]))
+        np.testing.assert_array_equal(values, [[1.0, np.nan]])
+
+
+class InterpolateLevelsTest(unittest.TestCase):
+
+    def test_interpolates_between_levels(self):
+        stack = np.array([[[0.0, 0.0, 0.0]], [[10.0, np.nan, 10.0]]])
+        values = interpolate_levels(stack, np.array([[0, 0, -1]]), np.array([[1, 1, 1]]),
+                                    np.array([[0.25, 0.25, 0.5]]))
+        np.testing.assert_allclose(values, [[2.5, 0.0, np.nan]])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+# Checks of NetCDFSlabReader on a small synthetic NetCDF4 file laid out like the World Ocean Atlas
+# ones it reads, these need netCDF4 but no ArcGIS.  Run from the repository folder with:
+# python -m unittest discover tests
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Tools"))
+
+from Includes import GridDescriptor
+from Includes import NetCDFSlabReader
+
+try:
+    import netCDF4
+except ImportError:
+    netCDF4 = None
+
+DEPTHS = [0.0, 10.0, 20.0]
+# Stored north to south and from 0 to 360, the reader hands rows back south to north and columns
+# from -180 to 180
+LAT = np.array([67.5, 22.5, -22.5, -67.5])
+LON = np.arange(22.5, 360, 45.0)
+FILL = -32767
+
+
+def expected(time_index, depth_index, lat, lon):
+    '''
+     Value of the synthetic variable, whole multiples of the scale factor so it packs exactly.
+    '''
+    return 1000.0 * time_index + 100.0 * depth_index + lat[:, np.newaxis] / 2.5 + lon[np.newaxis] / 22.5
+
+
+def make_file(path):
+    dataset = netCDF4.Dataset(path, "w")
+    dataset.createDimension("time", 2)
+    dataset.createDimension("depth", len(DEPTHS))
+    dataset.createDimension("lat", len(LAT))
+    dataset.createDimension("lon", len(LON))
+    dataset.createVariable("depth", "f4", ("depth",))[:] = DEPTHS
+    dataset.createVariable("lat", "f4", ("lat",))[:] = LAT
+    dataset.createVariable("lon", "f4", ("lon",))[:] = LON
+
+    variable = dataset.createVariable("t_an", "i2", ("time", "depth", "lat", "lon"), fill_value=FILL)
+    variable.scale_factor = 0.5
+    variable.add_offset = 100.0
+    variable.set_auto_maskandscale(False)
+    wrapped = np.where(LON > 180, LON - 360, LON)
+    packed = np.empty((2, len(DEPTHS), len(LAT), len(LON)), dtype=np.int16)
+    for time_index in range(2):
+        for depth_index in range(len(DEPTHS)):
+            packed[time_index, depth_index] = (expected(time_index, depth_index, LAT, wrapped) - 100.0) / 0.5
+    # The deepest level has no data along 22.5S
+    packed[:, 2, 2, :] = FILL
+    variable[:] = packed
+    dataset.close()
+
+
+@unittest.skipIf(netCDF4 is None, "netCDF4 is not installed")
+class NetCDFSlabReaderTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "synthetic.nc")
+        make_file(self.path)
+        self.lat = np.sort(LAT)
+        self.lon = np.sort(np.where(LON > 180, LON - 360, LON))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_rolls_and_scales(self):
+        with NetCDFSlabReader(self.path, "t_an") as reader:
+            np.testing.assert_array_equal(reader.lat, self.lat)
+            np.testing.assert_array_equal(reader.lon, self.lon)
+            self.assertEqual(reader.time_count, 2)
+            values = reader.read(time_index=1)
+        self.assertEqual(values.shape, (3, 4, 8))
+        for depth_index in range(2):
+            np.testing.assert_allclose(values[depth_index], expected(1, depth_index, self.lat, self.lon))
+
+    def test_fill_values_are_nan(self):
+        with NetCDFSlabReader(self.path, "t_an") as reader:
+            values = reader.read_depth(20)
+        self.assertTrue(np.isnan(values[1]).all())
+        np.testing.assert_allclose(values[[0, 2, 3]], expected(0, 2, self.lat, self.lon)[[0, 2, 3]])
+
+    def test_crops_across_the_date_line(self):
+        # Longitudes -67.5 to 67.5 wrap around the end of the 0 to 360 file
+        with NetCDFSlabReader(self.path, "t_an", "-100 -50 100 50") as reader:
+            self.assertEqual(reader.grid, GridDescriptor(-90, -45, 45, 45, 2, 4))
+            values = reader.read_depth(10, time_index=1)
+        np.testing.assert_allclose(values, expected(1, 1, self.lat[1:3], self.lon[2:6]))
+
+    def test_window(self):
+        with NetCDFSlabReader(self.path, "t_an") as reader:
+            values = reader.read([0, 10], window=(1, 3, 6, 8))
+        np.testing.assert_allclose(values[1], expected(0, 1, self.lat[1:3], self.lon[6:8]))
+
+    def test_valid_counts(self):
+        with NetCDFSlabReader(self.path, "t_an") as reader:
+            np.testing.assert_array_equal(reader.valid_counts([0, 10, 20, 30]), [32, 32, 24, 0])
+        with NetCDFSlabReader(self.path, "t_an", "-100 -50 100 50") as reader:
+            np.testing.assert_array_equal(reader.valid_counts([20, 0]), [4, 8])
+
+
+if __name__ == "__main__":
+    unittest.main()